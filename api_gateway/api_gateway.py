@@ -1,18 +1,27 @@
-from fastapi import FastAPI, HTTPException
-from fastapi.responses import StreamingResponse
+from fastapi import FastAPI, HTTPException, Request, WebSocket, WebSocketDisconnect
+from fastapi.responses import StreamingResponse, Response, JSONResponse
 from fastapi.middleware.cors import CORSMiddleware
-from pydantic import BaseModel
-from typing import Optional, Dict, Set
+from pydantic import BaseModel, ValidationError
+from typing import Optional, Dict, Set, List
 import httpx
 import asyncio
+import os
+import time
 import json
 from datetime import datetime
+from collections import deque
 import pika
 from pika.exchange_type import ExchangeType
 import threading
+import itertools
+import zlib
+import sqlite3
+from uuid import uuid4
 import uvicorn
-from model.leilao import Leilao
+from model.leilao import Leilao, StatusLeilao
 from model.lance import Lance
+from model.particao import AnelConsistente
+from model.roteamento import EXCHANGE_EVENTOS, chaves_leilao, chaves_usuario, tipo_da_chave
 
 app = FastAPI(title="API Gateway")
 
@@ -22,6 +31,7 @@ app.add_middleware(
     allow_credentials=True,
     allow_methods=["*"],
     allow_headers=["*"],
+    expose_headers=["ETag", "X-Proximo-Cursor"],
 )
 
 # Configurações dos microsserviços
@@ -29,14 +39,91 @@ PAGAMENTO_SERVICE_URL = "http://localhost:8002"
 LEILAO_SERVICE_URL = "http://localhost:8001"
 LANCE_SERVICE_URL = "http://localhost:8000"
 
+# Instâncias do MS Lance ("id=url,id=url"); cada lance vai para a dona do leilão
+LANCE_INSTANCIAS = os.environ.get("LANCE_INSTANCIAS", f"lance-0={LANCE_SERVICE_URL}")
+anel_lance = AnelConsistente.from_config(LANCE_INSTANCIAS)
+
+# Importações em lote podem levar mais que o timeout padrão do httpx
+TIMEOUT_LOTE = 60.0
+
+# ---- Clientes HTTP persistentes por upstream ----
+POOL_MAX_CONEXOES = int(os.environ.get("GATEWAY_POOL_MAX_CONEXOES", "200"))
+POOL_MAX_KEEPALIVE = int(os.environ.get("GATEWAY_POOL_MAX_KEEPALIVE", "50"))
+KEEPALIVE_EXPIRA = float(os.environ.get("GATEWAY_KEEPALIVE_EXPIRA", "30"))
+TIMEOUT_CONEXAO = float(os.environ.get("GATEWAY_TIMEOUT_CONEXAO", "2.0"))
+TIMEOUT_LEITURA = float(os.environ.get("GATEWAY_TIMEOUT_LEITURA", "5.0"))
+# Tempo máximo esperando uma conexão livre no pool antes de desistir
+TIMEOUT_POOL = float(os.environ.get("GATEWAY_TIMEOUT_POOL", "1.0"))
+USAR_HTTP2 = os.environ.get("GATEWAY_HTTP2", "0") == "1"
+if USAR_HTTP2:
+    try:
+        import h2  # noqa: F401
+    except ImportError:
+        print("[API GATEWAY] GATEWAY_HTTP2=1 mas o pacote h2 não está instalado; usando HTTP/1.1")
+        USAR_HTTP2 = False
+
+# Circuit breaker: falhas seguidas que abrem o circuito e por quanto tempo ele fica aberto
+DISJUNTOR_LIMITE_FALHAS = int(os.environ.get("GATEWAY_DISJUNTOR_FALHAS", "5"))
+DISJUNTOR_TEMPO_ABERTO = float(os.environ.get("GATEWAY_DISJUNTOR_ABERTO", "5.0"))
+
 
 # Gerenciamento de clientes SSE
-sse_clients: Dict[str, asyncio.Queue] = {}
+# Eventos pendentes por conexão antes da política de excesso entrar em ação
+CAPACIDADE_FILA_SSE = int(os.environ.get("GATEWAY_FILA_SSE", "256"))
+# "descartar_antigo" (tira o evento não crítico mais velho) ou "descartar_novo"
+POLITICA_EXCESSO = os.environ.get("GATEWAY_POLITICA_EXCESSO", "descartar_antigo")
+# Segundos com a fila cheia até a conexão lenta ser derrubada
+ATRASO_MAXIMO = float(os.environ.get("GATEWAY_ATRASO_MAXIMO", "30"))
+# Janela padrão (ms) para juntar eventos num único write; 0 envia assim que chegam
+JANELA_SSE_MS = int(os.environ.get("GATEWAY_JANELA_SSE_MS", "0"))
+JANELA_SSE_MAXIMA_MS = 1000
+# Compressão gzip/deflate do stream quando o cliente aceita (Accept-Encoding)
+COMPRESSAO_SSE = os.environ.get("GATEWAY_COMPRESSAO_SSE", "0") == "1"
+# Nunca descartados nem coalescidos, mesmo com a fila cheia
+EVENTOS_CRITICOS = {'leilao_vencedor', 'status_pagamento', 'link_pagamento', 'resync'}
+
+# cliente_id -> conexões abertas (o mesmo usuário pode ter várias abas)
+sse_clients: Dict[str, Set["ConexaoEventos"]] = {}
+# cliente_id -> leilões de interesse
 client_interests: Dict[str, Set[str]] = {}
+# Índice invertido: leilao_id -> clientes interessados
+interessados_por_leilao: Dict[str, Set[str]] = {}
 
 # Conexão RabbitMQ
 consumer_connection = None
 consumer_channel = None
+consumer_queues: List[str] = []
+
+# ---- Ponte broker -> event loop ----
+# Mensagens entregues sem ack por vez; limita a memória ocupada por eventos ainda não enfileirados
+PREFETCH_BROKER = int(os.environ.get("GATEWAY_PREFETCH", "1000"))
+INTERVALO_RECONEXAO = 2.0
+# Eventos do MS Leilão, recebidos integralmente (mantêm o cache de listagens)
+EVENTOS = ['leilao_iniciado', 'leilao_finalizado']
+# Fila dos eventos de lance/pagamento; só tem bindings para leilões e usuários assinados neste worker
+fila_eventos: Optional[str] = None
+# routing key de binding -> quantos clientes deste worker precisam dela
+ref_chaves: Dict[str, int] = {}
+
+# ---- Múltiplos workers ----
+# Processos uvicorn no mesmo porto; cada um com suas conexões, consumidor e índices
+WORKERS_GATEWAY = int(os.environ.get("GATEWAY_WORKERS", "1"))
+# Identifica o processo nas mensagens de controle e nos ids de evento
+WORKER_ID = uuid4().hex[:8]
+# Fanout interno por onde os workers replicam interesses, presença dos clientes, o anel do MS Lance
+# e a invalidação do cache de leilões
+EXCHANGE_CONTROLE = 'gateway_interesses'
+
+# ---- Interesses persistentes ----
+# SQLite compartilhado pelos workers; interesses sobrevivem a desconexões e reinícios
+GATEWAY_DB = os.environ.get("GATEWAY_DB", "gateway.db")
+# Espera após leilao_finalizado antes de apagar os interesses, para o leilao_vencedor ainda chegar
+ATRASO_LIMPEZA = float(os.environ.get("GATEWAY_ATRASO_LIMPEZA", "30"))
+
+# Loop do uvicorn, capturado no startup; a thread do pika só entra nele via call_soon_threadsafe
+loop_principal: Optional[asyncio.AbstractEventLoop] = None
+consumindo = False
+metricas_broker = {"lotes": 0, "eventos": 0, "descartados": 0, "reconexoes": 0}
 
 # Models
 class LeilaoCreate(BaseModel):
@@ -50,49 +137,914 @@ class LanceCreate(BaseModel):
     valor: float
     ts: str
 
+class MembrosLance(BaseModel):
+    instancias: Dict[str, str]
+
 class InterestRegister(BaseModel):
     cliente_id: str
     leilao_id: str
 
+class InteressesLote(BaseModel):
+    cliente_id: str
+    adicionar: List[str] = []
+    remover: List[str] = []
+
+class UpstreamIndisponivel(Exception):
+    """Circuito aberto: o upstream é rejeitado sem tentar a requisição"""
+    def __init__(self, url: str):
+        super().__init__(url)
+        self.url = url
+
+class DisjuntorUpstream:
+    """Circuit breaker de um upstream: fechado -> aberto após falhas seguidas -> meio-aberto (uma chamada de teste)"""
+
+    def __init__(self, limite_falhas: int, tempo_aberto: float):
+        self.limite_falhas = limite_falhas
+        self.tempo_aberto = tempo_aberto
+        self.falhas = 0
+        self.aberto_ate = 0.0
+        self.testando = False
+
+    @property
+    def estado(self) -> str:
+        if self.falhas < self.limite_falhas:
+            return "fechado"
+        if time.monotonic() < self.aberto_ate:
+            return "aberto"
+        return "meio_aberto"
+
+    def permitir(self) -> bool:
+        if self.falhas < self.limite_falhas:
+            return True
+        if time.monotonic() < self.aberto_ate or self.testando:
+            return False
+        # Meio-aberto: só uma requisição de teste até ela terminar
+        self.testando = True
+        return True
+
+    def sucesso(self):
+        self.falhas = 0
+        self.testando = False
+
+    def liberar(self):
+        """Requisição interrompida (ex.: cancelada) sem resultado: libera o teste sem contar nada"""
+        self.testando = False
+
+    def falha(self):
+        self.falhas += 1
+        self.testando = False
+        if self.falhas >= self.limite_falhas:
+            self.aberto_ate = time.monotonic() + self.tempo_aberto
+
+class Upstream:
+    """Cliente httpx de longa duração (pool com keep-alive) e disjuntor de um microsserviço"""
+
+    def __init__(self, url: str):
+        self.url = url
+        self.cliente = httpx.AsyncClient(
+            base_url=url,
+            http2=USAR_HTTP2,
+            limits=httpx.Limits(
+                max_connections=POOL_MAX_CONEXOES,
+                max_keepalive_connections=POOL_MAX_KEEPALIVE,
+                keepalive_expiry=KEEPALIVE_EXPIRA
+            ),
+            timeout=httpx.Timeout(TIMEOUT_LEITURA, connect=TIMEOUT_CONEXAO, pool=TIMEOUT_POOL)
+        )
+        self.disjuntor = DisjuntorUpstream(DISJUNTOR_LIMITE_FALHAS, DISJUNTOR_TEMPO_ABERTO)
+        self.requisicoes = 0
+        self.rejeitadas = 0
+
+    async def requisitar(self, metodo: str, caminho: str, **kwargs) -> httpx.Response:
+        """Falhas de transporte e respostas 5xx contam para o disjuntor; 4xx não"""
+        if not self.disjuntor.permitir():
+            self.rejeitadas += 1
+            raise UpstreamIndisponivel(self.url)
+        self.requisicoes += 1
+        try:
+            response = await self.cliente.request(metodo, caminho, **kwargs)
+        except httpx.TransportError:
+            self.disjuntor.falha()
+            raise
+        except BaseException:
+            # Inclui CancelledError quando o cliente desconecta no meio da requisição
+            self.disjuntor.liberar()
+            raise
+        if response.status_code >= 500:
+            self.disjuntor.falha()
+        else:
+            self.disjuntor.sucesso()
+        return response
+
+    def metricas(self):
+        return {
+            "estado": self.disjuntor.estado,
+            "falhas_seguidas": self.disjuntor.falhas,
+            "requisicoes": self.requisicoes,
+            "rejeitadas": self.rejeitadas
+        }
+
+# URL base -> Upstream; instâncias novas do MS Lance ganham cliente na primeira requisição
+upstreams: Dict[str, Upstream] = {}
+
+def upstream(url: str) -> Upstream:
+    if url not in upstreams:
+        upstreams[url] = Upstream(url)
+    return upstreams[url]
+
+async def fechar_upstreams(urls):
+    for url in urls:
+        cliente = upstreams.pop(url, None)
+        if cliente:
+            await cliente.cliente.aclose()
+
+@app.exception_handler(UpstreamIndisponivel)
+async def upstream_indisponivel(request: Request, exc: UpstreamIndisponivel):
+    return JSONResponse(
+        status_code=503,
+        content={"detail": f"Serviço indisponível: {exc.url}"},
+        headers={"Retry-After": str(int(DISJUNTOR_TEMPO_ABERTO))}
+    )
+
 # Endpoints REST
 @app.post("/leilao")
 async def criar_leilao(leilao: LeilaoCreate):
-    async with httpx.AsyncClient() as client:
+    try:
+        response = await upstream(LEILAO_SERVICE_URL).requisitar(
+            "POST", "/leilao",
+            json=leilao.model_dump()  # httpx serializa automaticamente
+        )
+        response.raise_for_status()
+        # Leilões aguardando não geram evento: a próxima listagem recarrega (em todos os workers)
+        invalidar_cache_leiloes()
+        return response.json()
+    except httpx.HTTPError as e:
+        raise HTTPException(status_code=500, detail=f"Erro ao criar leilão: {str(e)}")
+
+@app.post("/leilao/batch")
+async def criar_leiloes_lote(leiloes: List[LeilaoCreate]):
+    try:
+        response = await upstream(LEILAO_SERVICE_URL).requisitar(
+            "POST", "/leilao/batch",
+            json=[leilao.model_dump() for leilao in leiloes],
+            timeout=TIMEOUT_LOTE
+        )
+        response.raise_for_status()
+        invalidar_cache_leiloes()
+        return response.json()
+    except httpx.HTTPError as e:
+        raise HTTPException(status_code=500, detail=f"Erro ao criar leilões em lote: {str(e)}")
+
+# Cabeçalhos de listagem repassados entre cliente e MS Leilão
+CABECALHOS_LISTAGEM = ("ETag", "X-Proximo-Cursor")
+
+# ---- Cache de listagens ----
+# Recarga completa mesmo sem eventos: cobre leilões criados fora do gateway (ainda sem evento)
+TTL_CACHE_LEILOES = float(os.environ.get("GATEWAY_TTL_LEILOES", "60"))
+STATUS_VALIDOS = {status.value for status in StatusLeilao}
+
+class CacheLeiloes:
+    """Cópia local dos leilões, corrigida por leilao_iniciado/leilao_finalizado e recarregada por TTL"""
+
+    def __init__(self):
+        self.leiloes: Dict[str, dict] = {}
+        self.versao = 0
+        # Distingue ETags de execuções diferentes do gateway
+        self.epoca = int(time.time())
+        self.carregado_em: Optional[float] = None
+        self.carga: Optional[asyncio.Future] = None
+        # Eventos recebidos durante uma recarga são reaplicados sobre a lista nova
+        self.durante_carga: list = []
+        # (status, ordem) -> corpo JSON pronto, descartado a cada mudança
+        self.corpos: Dict[tuple, bytes] = {}
+        self.acertos = 0
+        self.recargas = 0
+
+    @property
+    def etag(self) -> str:
+        return f'W/"gw-{self.epoca}-{self.versao}"'
+
+    def _mudou(self):
+        self.versao += 1
+        self.corpos.clear()
+
+    async def garantir(self):
+        """Recarrega do MS Leilão se expirado; requisições simultâneas esperam a mesma recarga"""
+        if self.carregado_em is not None and time.monotonic() - self.carregado_em < TTL_CACHE_LEILOES:
+            return
+        if self.carga is None:
+            self.carga = asyncio.ensure_future(self._recarregar())
         try:
-            response = await client.post(
-                f"{LEILAO_SERVICE_URL}/leilao", 
-                json=leilao.model_dump()  # httpx serializa automaticamente
-            )
+            await asyncio.shield(self.carga)
+        finally:
+            if self.carga is not None and self.carga.done():
+                self.carga = None
+
+    async def _recarregar(self):
+        self.durante_carga = []
+        try:
+            response = await upstream(LEILAO_SERVICE_URL).requisitar("GET", "/leilao")
             response.raise_for_status()
-            return response.json()
-        except httpx.HTTPError as e:
-            raise HTTPException(status_code=500, detail=f"Erro ao criar leilão: {str(e)}")
+            self.leiloes = {str(leilao["id"]): leilao for leilao in response.json()}
+        finally:
+            pendentes, self.durante_carga = self.durante_carga, None
+        for event_type, event_data in pendentes:
+            self.aplicar(event_type, event_data)
+        self.carregado_em = time.monotonic()
+        self.recargas += 1
+        self._mudou()
+
+    def aplicar(self, event_type: str, event_data: dict):
+        if self.durante_carga is not None:
+            self.durante_carga.append((event_type, event_data))
+        if event_type == 'leilao_iniciado':
+            self.leiloes[str(event_data["id"])] = event_data
+        elif event_type == 'leilao_finalizado':
+            leilao = self.leiloes.get(str(event_data["id"]))
+            if leilao is None:
+                # Leilão desconhecido: a próxima leitura recarrega a lista
+                self.invalidar()
+                return
+            self.leiloes[str(event_data["id"])] = {**leilao, "status": StatusLeilao.ENCERRADO.value}
+        self._mudou()
+
+    def invalidar(self):
+        self.carregado_em = None
+
+    def corpo(self, status: Optional[str], ordem: str) -> bytes:
+        chave = (status, ordem)
+        if chave not in self.corpos:
+            # Mesma ordenação do MS Leilão: (campo de ordem, id)
+            itens = sorted(
+                (leilao for leilao in self.leiloes.values() if status is None or leilao.get("status") == status),
+                key=lambda leilao: (leilao[ordem], str(leilao["id"]))
+            )
+            self.corpos[chave] = json.dumps(itens, separators=(",", ":")).encode()
+        else:
+            self.acertos += 1
+        return self.corpos[chave]
+
+    def metricas(self):
+        return {
+            "leiloes": len(self.leiloes),
+            "versao": self.versao,
+            "idade_s": round(time.monotonic() - self.carregado_em, 3) if self.carregado_em is not None else None,
+            "acertos": self.acertos,
+            "recargas": self.recargas
+        }
+
+cache_leiloes = CacheLeiloes()
+
+def invalidar_cache_leiloes():
+    cache_leiloes.invalidar()
+    publicar_controle({"op": "invalidar_cache"})
+
+def consulta_em_cache(params) -> bool:
+    """Só listagens completas (filtro de status e ordem) saem do cache; janela, cursor e limite vão ao MS Leilão"""
+    return (
+        set(params) <= {"status", "ordem"}
+        and params.get("ordem", "inicio") in ("inicio", "fim")
+        and params.get("status", StatusLeilao.ATIVO.value) in STATUS_VALIDOS
+    )
+
+@app.get("/leilao/cache")
+async def obter_metricas_cache():
+    return cache_leiloes.metricas()
 
 @app.get("/leilao")
-async def consultar_leiloes_ativos():
-    async with httpx.AsyncClient() as client:
+async def consultar_leiloes_ativos(request: Request):
+    """Listagens completas saem do cache local; as demais repassam filtros, cursor e If-None-Match ao MS Leilão"""
+    if consulta_em_cache(request.query_params):
         try:
-            response = await client.get(f"{LEILAO_SERVICE_URL}/leilao")
-            response.raise_for_status()
-            return response.json()
+            await cache_leiloes.garantir()
         except httpx.HTTPError as e:
             raise HTTPException(status_code=500, detail=f"Erro ao consultar leilões: {str(e)}")
+        etag = cache_leiloes.etag
+        if etag in (tag.strip() for tag in request.headers.get("if-none-match", "").split(",")):
+            return Response(status_code=304, headers={"ETag": etag})
+        corpo = cache_leiloes.corpo(request.query_params.get("status"), request.query_params.get("ordem", "inicio"))
+        return Response(content=corpo, media_type="application/json", headers={"ETag": etag})
+
+    headers = {}
+    if "if-none-match" in request.headers:
+        headers["If-None-Match"] = request.headers["if-none-match"]
+    try:
+        response = await upstream(LEILAO_SERVICE_URL).requisitar(
+            "GET", "/leilao",
+            params=request.query_params,
+            headers=headers
+        )
+        repassados = {h: response.headers[h] for h in CABECALHOS_LISTAGEM if h in response.headers}
+        if response.status_code == 304:
+            return Response(status_code=304, headers=repassados)
+        if 400 <= response.status_code < 500:
+            # Erro do cliente (cursor ou filtro inválido) é repassado como veio
+            return Response(content=response.content, status_code=response.status_code,
+                            media_type=response.headers.get("content-type", "application/json"))
+        response.raise_for_status()
+        return Response(content=response.content, media_type="application/json", headers=repassados)
+    except httpx.HTTPError as e:
+        raise HTTPException(status_code=500, detail=f"Erro ao consultar leilões: {str(e)}")
 
 @app.post("/lance")
 async def efetuar_lance(lance: LanceCreate):
-    async with httpx.AsyncClient() as client:
+    try:
+        response = await upstream(anel_lance.url(lance.id_leilao)).requisitar(
+            "POST", "/lance",
+            json=lance.model_dump()
+        )
+        response.raise_for_status()
+        return response.json()
+    except httpx.HTTPError as e:
+        print(f"Erro detalhado: {e}")
+        if hasattr(e, 'response'):
+            print(f"Response body: {e.response.text}")
+        raise HTTPException(status_code=500, detail=f"Erro ao efetuar lance: {str(e)}")
+
+async def encaminhar_lances(lances: List[LanceCreate]) -> list:
+    """Divide o lote pela instância dona de cada leilão e remonta os resultados na ordem original"""
+    por_url: Dict[str, List[int]] = {}
+    for i, lance in enumerate(lances):
+        por_url.setdefault(anel_lance.url(lance.id_leilao), []).append(i)
+
+    async def enviar(url, indices):
+        response = await upstream(url).requisitar(
+            "POST", "/lance/batch",
+            json=[lances[i].model_dump() for i in indices],
+            timeout=TIMEOUT_LOTE
+        )
+        response.raise_for_status()
+        return response.json()["resultados"]
+
+    resultados = [None] * len(lances)
+    respostas = await asyncio.gather(
+        *(enviar(url, indices) for url, indices in por_url.items()), return_exceptions=True
+    )
+    for (url, indices), parciais in zip(por_url.items(), respostas):
+        if isinstance(parciais, BaseException):
+            # Só os lances dessa instância falham; os das outras já foram aceitos e publicados
+            if not isinstance(parciais, (httpx.HTTPError, UpstreamIndisponivel)):
+                raise parciais
+            if isinstance(parciais, httpx.HTTPStatusError):
+                codigo = parciais.response.status_code
+            else:
+                codigo = 503 if isinstance(parciais, UpstreamIndisponivel) else 502
+            print(f"[API GATEWAY] Falha ao encaminhar {len(indices)} lances para {url}: {parciais}")
+            parciais = [{"status": "error", "codigo": codigo, "message": f"Erro ao efetuar lance: {parciais}"}] * len(indices)
+        for i, resultado in zip(indices, parciais):
+            resultados[i] = resultado
+    return resultados
+
+@app.post("/lance/batch")
+async def efetuar_lances_lote(lances: List[LanceCreate]):
+    try:
+        return {"resultados": await encaminhar_lances(lances)}
+    except httpx.HTTPError as e:
+        raise HTTPException(status_code=500, detail=f"Erro ao efetuar lances em lote: {str(e)}")
+
+@app.get("/lance/membros")
+async def obter_membros_lance():
+    return anel_lance.to_dict()
+
+def trocar_anel_lance(novo: AnelConsistente, fechar_removidas: bool = True) -> Optional[AnelConsistente]:
+    """Adota o anel se for mais novo; retorna o anterior (ou None se nada mudou)"""
+    global anel_lance
+    antigo = anel_lance
+    if novo.versao <= antigo.versao:
+        return None
+    anel_lance = novo
+    if fechar_removidas:
+        # Instâncias que saíram do anel não recebem mais lances
+        asyncio.ensure_future(fechar_upstreams(set(antigo.instancias.values()) - set(novo.instancias.values())))
+    return antigo
+
+async def sincronizar_anel_lance():
+    """No startup, adota o anel mais novo conhecido pelas instâncias configuradas"""
+    for url in list(anel_lance.instancias.values()):
         try:
-            response = await client.post(
-                f"{LANCE_SERVICE_URL}/lance", 
-                json=lance.model_dump()
-            )
+            response = await upstream(url).requisitar("GET", "/membros")
             response.raise_for_status()
-            return response.json()
-        except httpx.HTTPError as e:
-            print(f"Erro detalhado: {e}")
-            if hasattr(e, 'response'):
-                print(f"Response body: {e.response.text}")
-            raise HTTPException(status_code=500, detail=f"Erro ao efetuar lance: {str(e)}")
+            dados = response.json()
+        except (httpx.HTTPError, UpstreamIndisponivel, ValueError) as e:
+            print(f"[API GATEWAY] Membros do MS Lance indisponíveis em {url}: {e}")
+            continue
+        trocar_anel_lance(AnelConsistente(instancias=dados["instancias"], versao=dados["versao"]))
+
+@app.put("/lance/membros")
+async def alterar_membros_lance(membros: MembrosLance):
+    """Troca as instâncias do MS Lance e propaga o novo anel para antigas e novas instâncias e workers"""
+    # Versão baseada no relógio continua crescendo mesmo após reinício do gateway
+    versao = max(anel_lance.versao + 1, int(time.time() * 1000))
+    # As instâncias removidas ainda precisam receber o anel novo: fechadas só depois do PUT
+    antigo = trocar_anel_lance(AnelConsistente(instancias=membros.instancias, versao=versao), fechar_removidas=False)
+    publicar_controle({"op": "anel", **anel_lance.to_dict()})
+    urls = list(set(antigo.instancias.values()) | set(anel_lance.instancias.values()))
+    respostas = await asyncio.gather(
+        *(upstream(url).requisitar("PUT", "/membros", json=anel_lance.to_dict()) for url in urls),
+        return_exceptions=True
+    )
+    falhas = [url for url, r in zip(urls, respostas) if isinstance(r, Exception) or r.is_error]
+    await fechar_upstreams(set(antigo.instancias.values()) - set(anel_lance.instancias.values()))
+    return {**anel_lance.to_dict(), "falhas": falhas}
+
+@app.get("/broker")
+async def obter_metricas_broker():
+    return {**metricas_broker, "prefetch": PREFETCH_BROKER, "worker": WORKER_ID, "bindings": len(ref_chaves)}
+
+@app.get("/upstreams")
+async def obter_upstreams():
+    return {url: cliente.metricas() for url, cliente in upstreams.items()}
+
+# Ids de evento crescentes; o mesmo id vai para todos os destinatários de um evento.
+# Partem do relógio (ms * 1000) para continuarem crescendo após um reinício do gateway
+contador_eventos = itertools.count(int(time.time() * 1000) * 1000)
+
+class EventoCodificado:
+    """Evento serializado uma única vez; o mesmo objeto imutável é compartilhado por todas as filas"""
+    __slots__ = ("id", "tipo", "leilao_id", "json", "quadro")
+
+    def __init__(self, tipo: str, leilao_id: Optional[str], dados: dict, com_id: bool = True):
+        # Sem id o navegador mantém o Last-Event-ID anterior
+        self.id = next(contador_eventos) if com_id else None
+        self.tipo = tipo
+        self.leilao_id = leilao_id
+        # Id público "<n>.<worker>": anéis de reenvio são locais ao worker que gerou o id
+        rotulo = f"{self.id}.{WORKER_ID}" if com_id else None
+        self.json = json.dumps({
+            "id": rotulo,
+            "type": tipo,
+            "data": dados,
+            "timestamp": datetime.now().isoformat()
+        }, separators=(",", ":")).encode()
+        # Quadro SSE pronto: "id:" alimenta o Last-Event-ID do navegador
+        if rotulo is None:
+            self.quadro = b"data: %s\n\n" % self.json
+        else:
+            self.quadro = b"id: %s\ndata: %s\n\n" % (rotulo.encode(), self.json)
+
+# ---- Reenvio na reconexão (Last-Event-ID) ----
+# Eventos recentes guardados por leilão e por usuário
+TAMANHO_REPLAY = int(os.environ.get("GATEWAY_TAMANHO_REPLAY", "256"))
+# Anéis sem eventos novos há mais que isso são descartados
+RETENCAO_REPLAY = float(os.environ.get("GATEWAY_RETENCAO_REPLAY", "600"))
+# Após a última conexão fechar, o worker ainda guarda eventos do cliente (e mantém os bindings) por esse tempo
+GRACA_RECONEXAO = float(os.environ.get("GATEWAY_GRACA_RECONEXAO", "60"))
+
+class HistoricoEventos:
+    """Anel limitado dos eventos recentes de cada chave (leilão ou usuário)"""
+
+    def __init__(self, tamanho: int):
+        self.tamanho = tamanho
+        self.aneis: Dict[str, deque] = {}
+        self.ultimo_uso: Dict[str, float] = {}
+        # Maior id que já saiu do anel: reconexões anteriores a ele perderam eventos
+        self.descartado_ate: Dict[str, int] = {}
+
+    def registrar(self, chave: str, evento: "EventoCodificado"):
+        anel = self.aneis.get(chave)
+        if anel is None:
+            anel = self.aneis[chave] = deque(maxlen=self.tamanho)
+        elif len(anel) == self.tamanho:
+            self.descartado_ate[chave] = anel[0].id
+        anel.append(evento)
+        self.ultimo_uso[chave] = time.monotonic()
+
+    def desde(self, chave: str, ultimo_id: int):
+        """(eventos com id > ultimo_id, se houve perda além do anel); percorre só os eventos perdidos"""
+        anel = self.aneis.get(chave)
+        perdidos = []
+        if anel:
+            for evento in reversed(anel):
+                if evento.id <= ultimo_id:
+                    break
+                perdidos.append(evento)
+            perdidos.reverse()
+        return perdidos, self.descartado_ate.get(chave, 0) > ultimo_id
+
+    def varrer(self, idade_maxima: float):
+        limite = time.monotonic() - idade_maxima
+        for chave in [chave for chave, uso in self.ultimo_uso.items() if uso < limite]:
+            del self.aneis[chave], self.ultimo_uso[chave]
+            self.descartado_ate.pop(chave, None)
+
+replay_leiloes = HistoricoEventos(TAMANHO_REPLAY)
+replay_usuarios = HistoricoEventos(TAMANHO_REPLAY)
+# cliente_id -> prazo (monotonic) para reconectar antes de perder os interesses
+em_graca: Dict[str, float] = {}
+tarefa_manutencao: Optional[asyncio.Task] = None
+
+QUADRO_CONECTADO = f"data: {json.dumps({'type': 'connected', 'message': 'Conectado ao stream de eventos'})}\n\n".encode()
+
+class ConexaoEventos:
+    """Fila limitada de uma conexão de eventos (SSE ou WebSocket) com coalescência de lances por leilão"""
+
+    def __init__(self, cliente_id: str):
+        self.cliente_id = cliente_id
+        # Itens [tipo, leilao_id, EventoCodificado, enfileirado_em]
+        self.fila = deque()
+        # leilao_id -> item lance_validado ainda na fila, substituído pelo lance mais novo
+        self.ultimo_lance: Dict[str, list] = {}
+        self.sinal = asyncio.Event()
+        self.cheia_desde: Optional[float] = None
+        self.desconectada = False
+        self.entregues = 0
+        self.coalescidos = 0
+        self.descartados = 0
+        self.escritas = 0
+
+    def colocar(self, tipo: str, leilao_id: Optional[str], evento: EventoCodificado):
+        if self.desconectada:
+            return
+        if tipo == 'lance_validado':
+            pendente = self.ultimo_lance.get(leilao_id)
+            if pendente is not None:
+                # Cliente só precisa do lance mais recente; mantém a posição e o tempo de espera
+                pendente[2] = evento
+                self.coalescidos += 1
+                return
+        elif tipo in EVENTOS_CRITICOS:
+            # Um lance posterior não pode passar à frente do vencedor
+            self.ultimo_lance.pop(leilao_id, None)
+
+        if len(self.fila) >= CAPACIDADE_FILA_SSE and tipo not in EVENTOS_CRITICOS:
+            if not self._abrir_espaco():
+                self.descartados += 1
+                # Descartar não basta: um cliente parado ainda precisa ser desconectado
+                self._verificar_atraso(time.monotonic())
+                if self.desconectada:
+                    self.sinal.set()
+                return
+
+        item = [tipo, leilao_id, evento, time.monotonic()]
+        self.fila.append(item)
+        if tipo == 'lance_validado':
+            self.ultimo_lance[leilao_id] = item
+        self._verificar_atraso(item[3])
+        self.sinal.set()
+
+    def _abrir_espaco(self) -> bool:
+        if POLITICA_EXCESSO != "descartar_antigo":
+            return False
+        for item in self.fila:
+            if item[0] not in EVENTOS_CRITICOS:
+                self.fila.remove(item)
+                if self.ultimo_lance.get(item[1]) is item:
+                    del self.ultimo_lance[item[1]]
+                self.descartados += 1
+                return True
+        return False
+
+    def _verificar_atraso(self, agora: float):
+        if len(self.fila) < CAPACIDADE_FILA_SSE:
+            self.cheia_desde = None
+        elif self.cheia_desde is None:
+            self.cheia_desde = agora
+        elif agora - self.cheia_desde > ATRASO_MAXIMO:
+            print(f"[API GATEWAY] Cliente {self.cliente_id} lento demais, desconectando")
+            self.desconectada = True
+
+    async def retirar(self, janela: float = 0.0) -> List[EventoCodificado]:
+        """
+        Espera e retira todos os eventos pendentes; lista vazia quando a conexão foi derrubada.
+        Com janela (s), espera mais esse tempo após o primeiro evento: o que chegar sai junto
+        e lances do mesmo leilão ainda são coalescidos.
+        """
+        while not self.fila and not self.desconectada:
+            self.sinal.clear()
+            await self.sinal.wait()
+        if janela and not self.desconectada:
+            await asyncio.sleep(janela)
+        if self.desconectada:
+            return []
+        self.escritas += 1
+        eventos = [item[2] for item in self.fila]
+        self.fila.clear()
+        self.ultimo_lance.clear()
+        self.cheia_desde = None
+        self.entregues += len(eventos)
+        return eventos
+
+    def metricas(self):
+        return {
+            "cliente_id": self.cliente_id,
+            "pendentes": len(self.fila),
+            "atraso_s": round(time.monotonic() - self.fila[0][3], 3) if self.fila else 0.0,
+            "entregues": self.entregues,
+            "escritas": self.escritas,
+            "coalescidos": self.coalescidos,
+            "descartados": self.descartados
+        }
+
+# ---- Índices de interesse ----
+def publicar_controle(mensagem: dict):
+    """Replica para os outros workers uma mudança de interesse, presença, anel do MS Lance ou cache de leilões"""
+    if WORKERS_GATEWAY <= 1:
+        return
+    conexao, canal = consumer_connection, consumer_channel
+    if conexao is None or conexao.is_closed:
+        print(f"[API GATEWAY] Sem conexão com RabbitMQ, controle não replicado: {mensagem}")
+        return
+    corpo = json.dumps({**mensagem, "worker": WORKER_ID}).encode()
+    # O canal pertence à thread consumidora: a publicação roda lá
+    conexao.add_callback_threadsafe(
+        lambda: canal.basic_publish(exchange=EXCHANGE_CONTROLE, routing_key='', body=corpo)
+    )
+
+def alterar_bindings(chaves: List[str], delta: int):
+    """Conta referências por routing key; só a primeira referência cria o binding e a última o remove"""
+    novas, removidas = [], []
+    for chave in chaves:
+        quantidade = ref_chaves.get(chave, 0) + delta
+        if quantidade > 0:
+            if chave not in ref_chaves:
+                novas.append(chave)
+            ref_chaves[chave] = quantidade
+        elif ref_chaves.pop(chave, None) is not None:
+            removidas.append(chave)
+    if not novas and not removidas:
+        return
+
+    conexao, canal, fila = consumer_connection, consumer_channel, fila_eventos
+    if conexao is None or conexao.is_closed or fila is None:
+        # Sem conexão: init_consumer refaz os bindings a partir de ref_chaves
+        return
+
+    def aplicar():
+        for chave in novas:
+            canal.queue_bind(exchange=EXCHANGE_EVENTOS, queue=fila, routing_key=chave)
+        for chave in removidas:
+            canal.queue_unbind(exchange=EXCHANGE_EVENTOS, queue=fila, routing_key=chave)
+
+    try:
+        conexao.add_callback_threadsafe(aplicar)
+    except Exception as e:
+        print(f"[API GATEWAY] Falha ao alterar bindings: {e}")
+
+def cliente_local(cliente_id: str) -> bool:
+    """Cliente com conexão aberta ou em carência neste worker"""
+    return cliente_id in sse_clients or cliente_id in em_graca
+
+def chaves_do_cliente(cliente_id: str) -> List[str]:
+    chaves = chaves_usuario(cliente_id)
+    for leilao_id in client_interests.get(cliente_id, ()):
+        chaves.extend(chaves_leilao(leilao_id))
+    return chaves
+
+class RepositorioInteresses:
+    """
+    Pares (cliente, leilão) em SQLite; carregados inteiros no startup. As
+    escritas não bloqueiam o event loop: uma thread própria grava tudo o que
+    acumulou numa só transação.
+    """
+
+    def __init__(self):
+        self._conn = None
+        self._pendentes = deque()
+        self._cond = threading.Condition()
+        self._escritor = None
+
+    def abrir(self, caminho: str):
+        self._conn = sqlite3.connect(caminho, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        # Vários workers escrevem no mesmo arquivo
+        self._conn.execute("PRAGMA busy_timeout=5000")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS interesses ("
+            " cliente_id TEXT NOT NULL, leilao_id TEXT NOT NULL,"
+            " PRIMARY KEY (cliente_id, leilao_id)) WITHOUT ROWID"
+        )
+        self._conn.execute("CREATE INDEX IF NOT EXISTS interesses_leilao ON interesses (leilao_id)")
+        self._conn.commit()
+        self._escritor = threading.Thread(target=self._gravar_pendentes, daemon=True)
+        self._escritor.start()
+
+    def fechar(self):
+        """Grava o que ainda está pendente e fecha o banco"""
+        if self._escritor is None:
+            return
+        with self._cond:
+            self._pendentes.append(None)
+            self._cond.notify()
+        self._escritor.join()
+        self._escritor = None
+        self._conn.close()
+        self._conn = None
+
+    def carregar(self):
+        return self._conn.execute("SELECT cliente_id, leilao_id FROM interesses").fetchall()
+
+    def _enfileirar(self, sql: str, linhas):
+        if self._escritor is None:
+            return
+        with self._cond:
+            self._pendentes.append((sql, linhas))
+            self._cond.notify()
+
+    def _gravar_pendentes(self):
+        while True:
+            with self._cond:
+                while not self._pendentes:
+                    self._cond.wait()
+                lote = list(self._pendentes)
+                self._pendentes.clear()
+            operacoes = [operacao for operacao in lote if operacao is not None]
+            try:
+                with self._conn:
+                    for sql, linhas in operacoes:
+                        self._conn.executemany(sql, linhas)
+            except sqlite3.Error as e:
+                print(f"[API GATEWAY] Falha ao gravar {len(operacoes)} alterações de interesses: {e}")
+            if len(operacoes) < len(lote):
+                return
+
+    def adicionar(self, cliente_id: str, leiloes: List[str]):
+        self._enfileirar("INSERT OR IGNORE INTO interesses VALUES (?, ?)", [(cliente_id, l) for l in leiloes])
+
+    def remover(self, cliente_id: str, leiloes: List[str]):
+        self._enfileirar("DELETE FROM interesses WHERE cliente_id = ? AND leilao_id = ?",
+                         [(cliente_id, l) for l in leiloes])
+
+    def remover_leilao(self, leilao_id: str):
+        self._enfileirar("DELETE FROM interesses WHERE leilao_id = ?", [(leilao_id,)])
+
+repositorio_interesses = RepositorioInteresses()
+
+def adicionar_interesses(cliente_id: str, leiloes: List[str], propagar: bool = True) -> List[str]:
+    """Adiciona vários interesses de uma vez; só quem originou a mudança persiste e replica"""
+    atuais = client_interests.get(cliente_id, ())
+    novos = [leilao_id for leilao_id in dict.fromkeys(leiloes) if leilao_id not in atuais]
+    if not novos:
+        return novos
+    if cliente_local(cliente_id):
+        alterar_bindings([chave for leilao_id in novos for chave in chaves_leilao(leilao_id)], +1)
+    interesses = client_interests.setdefault(cliente_id, set())
+    for leilao_id in novos:
+        interesses.add(leilao_id)
+        interessados_por_leilao.setdefault(leilao_id, set()).add(cliente_id)
+    if propagar:
+        repositorio_interesses.adicionar(cliente_id, novos)
+        publicar_controle({"op": "adicionar", "cliente_id": cliente_id, "leiloes": novos})
+    return novos
+
+def remover_interesses(cliente_id: str, leiloes: List[str], propagar: bool = True) -> List[str]:
+    interesses = client_interests.get(cliente_id)
+    if not interesses:
+        return []
+    removidos = [leilao_id for leilao_id in dict.fromkeys(leiloes) if leilao_id in interesses]
+    if not removidos:
+        return removidos
+    for leilao_id in removidos:
+        interesses.discard(leilao_id)
+        clientes = interessados_por_leilao.get(leilao_id)
+        if clientes is not None:
+            clientes.discard(cliente_id)
+            if not clientes:
+                del interessados_por_leilao[leilao_id]
+    if not interesses:
+        del client_interests[cliente_id]
+    if cliente_local(cliente_id):
+        alterar_bindings([chave for leilao_id in removidos for chave in chaves_leilao(leilao_id)], -1)
+    if propagar:
+        repositorio_interesses.remover(cliente_id, removidos)
+        publicar_controle({"op": "remover", "cliente_id": cliente_id, "leiloes": removidos})
+    return removidos
+
+def adicionar_interesse(cliente_id: str, leilao_id: str, propagar: bool = True):
+    adicionar_interesses(cliente_id, [leilao_id], propagar)
+
+def remover_interesse(cliente_id: str, leilao_id: str, propagar: bool = True) -> bool:
+    return bool(remover_interesses(cliente_id, [leilao_id], propagar))
+
+def carregar_interesses():
+    """Reconstrói os índices a partir do SQLite (sem replicar: cada worker carrega o mesmo arquivo)"""
+    for cliente_id, leilao_id in repositorio_interesses.carregar():
+        client_interests.setdefault(cliente_id, set()).add(leilao_id)
+        interessados_por_leilao.setdefault(leilao_id, set()).add(cliente_id)
+    print(f"[API GATEWAY] {len(client_interests)} clientes e {len(interessados_por_leilao)} leilões com interesses carregados")
+
+# (prazo, leilao_id) de leilões encerrados com interessados, em ordem de prazo
+limpezas_pendentes: deque = deque()
+
+def agendar_limpeza(leilao_id: str):
+    """Só leilões com interessados entram na fila; a varredura roda em manter_conexoes"""
+    if leilao_id in interessados_por_leilao:
+        limpezas_pendentes.append((time.monotonic() + ATRASO_LIMPEZA, leilao_id))
+
+def limpar_leilao(leilao_id: str):
+    """Leilão encerrado: ninguém mais precisa dos seus eventos"""
+    if leilao_id not in interessados_por_leilao:
+        return
+    for cliente_id in list(interessados_por_leilao.get(leilao_id, ())):
+        remover_interesses(cliente_id, [leilao_id], propagar=False)
+    # Todo worker recebe o leilao_finalizado; o DELETE é idempotente
+    repositorio_interesses.remover_leilao(leilao_id)
+
+async def limpar_interesses_encerrados():
+    """No startup, descarta interesses de leilões encerrados enquanto o gateway estava parado"""
+    try:
+        await cache_leiloes.garantir()
+    except (httpx.HTTPError, UpstreamIndisponivel) as e:
+        print(f"[API GATEWAY] Limpeza de interesses adiada, MS Leilão indisponível: {e}")
+        return
+    encerrados = [
+        leilao_id for leilao_id in list(interessados_por_leilao)
+        if cache_leiloes.leiloes.get(leilao_id, {}).get("status") == StatusLeilao.ENCERRADO.value
+    ]
+    for leilao_id in encerrados:
+        limpar_leilao(leilao_id)
+    if encerrados:
+        print(f"[API GATEWAY] Interesses de {len(encerrados)} leilões encerrados removidos")
+
+def aplicar_controle(mensagem: dict):
+    """Aplica localmente uma mudança feita em outro worker"""
+    if mensagem.get("worker") == WORKER_ID:
+        return
+    op, cliente_id = mensagem.get("op"), mensagem.get("cliente_id")
+    if op == "adicionar":
+        adicionar_interesses(cliente_id, mensagem["leiloes"], propagar=False)
+    elif op == "remover":
+        remover_interesses(cliente_id, mensagem["leiloes"], propagar=False)
+    elif op == "invalidar_cache":
+        # Leilão criado por outro worker
+        cache_leiloes.invalidar()
+    elif op == "anel":
+        # PUT /lance/membros recebido por outro worker
+        trocar_anel_lance(AnelConsistente(instancias=mensagem["instancias"], versao=mensagem["versao"]))
+    elif op == "presenca":
+        # O cliente reconectou em outro worker: a carência daqui deixa de valer
+        if em_graca.pop(cliente_id, None) is not None:
+            alterar_bindings(chaves_do_cliente(cliente_id), -1)
+
+def eventos_perdidos(cliente_id: str, ultimo_id: int) -> List[EventoCodificado]:
+    """Eventos dos leilões de interesse e do próprio usuário posteriores a ultimo_id, em ordem de id"""
+    perdidos, houve_perda = replay_usuarios.desde(cliente_id, ultimo_id)
+    for leilao_id in client_interests.get(cliente_id, ()):
+        eventos, perda = replay_leiloes.desde(leilao_id, ultimo_id)
+        perdidos.extend(eventos)
+        houve_perda = houve_perda or perda
+    perdidos.sort(key=lambda evento: evento.id)
+    if houve_perda:
+        # Parte do intervalo já saiu dos anéis: o cliente deve recarregar o estado (GET /leilao)
+        perdidos.insert(0, evento_resync(ultimo_id))
+    return perdidos
+
+def evento_resync(ultimo_evento) -> EventoCodificado:
+    return EventoCodificado('resync', None, {"ultimo_evento": ultimo_evento}, com_id=False)
+
+def conectar(cliente_id: str, conexao: ConexaoEventos, ultimo_evento: Optional[str] = None):
+    """Registra a conexão e, numa reconexão, enfileira só o que foi perdido"""
+    estava_local = cliente_local(cliente_id)
+    if not estava_local:
+        publicar_controle({"op": "presenca", "cliente_id": cliente_id})
+        alterar_bindings(chaves_do_cliente(cliente_id), +1)
+    em_graca.pop(cliente_id, None)
+    sse_clients.setdefault(cliente_id, set()).add(conexao)
+
+    ultimo_id, de_outro_worker = ler_ultimo_evento(ultimo_evento)
+    if de_outro_worker or (ultimo_id is not None and not estava_local):
+        # Histórico de outro worker, ou carência vencida (eventos do cliente deixaram de ser
+        # guardados aqui): os anéis não cobrem o intervalo, só resta ressincronizar
+        conexao.colocar('resync', None, evento_resync(ultimo_evento))
+    elif ultimo_id is not None:
+        for evento in eventos_perdidos(cliente_id, ultimo_id):
+            conexao.colocar(evento.tipo, evento.leilao_id, evento)
+
+def desconectar(cliente_id: str, conexao: ConexaoEventos):
+    conexoes = sse_clients.get(cliente_id)
+    if conexoes is not None:
+        conexoes.discard(conexao)
+        if not conexoes:
+            del sse_clients[cliente_id]
+            # Sem nenhuma conexão aberta, os interesses esperam a carência de reconexão
+            em_graca[cliente_id] = time.monotonic() + GRACA_RECONEXAO
+
+async def manter_conexoes():
+    """Encerra carências vencidas, limpa interesses de leilões encerrados e descarta anéis de reenvio parados"""
+    while True:
+        await asyncio.sleep(1.0)
+        agora = time.monotonic()
+        for cliente_id in [cliente_id for cliente_id, prazo in em_graca.items() if prazo <= agora]:
+            del em_graca[cliente_id]
+            # Interesses continuam (persistidos); só os bindings deste worker saem
+            alterar_bindings(chaves_do_cliente(cliente_id), -1)
+        while limpezas_pendentes and limpezas_pendentes[0][0] <= agora:
+            limpar_leilao(limpezas_pendentes.popleft()[1])
+        replay_leiloes.varrer(RETENCAO_REPLAY)
+        replay_usuarios.varrer(RETENCAO_REPLAY)
+
+def ler_ultimo_evento(valor: Optional[str]):
+    """(id numérico, veio de outro worker) a partir de um Last-Event-ID "<n>.<worker>" """
+    if not valor:
+        return None, False
+    numero, _, worker = valor.partition(".")
+    try:
+        ultimo_id = int(numero)
+    except ValueError:
+        return None, False
+    if worker and worker != WORKER_ID:
+        return None, True
+    return ultimo_id, False
 
 @app.get("/interesses")
 async def obter_interesses():
@@ -100,71 +1052,207 @@ async def obter_interesses():
 
 @app.post("/interesses")
 async def registrar_interesse(interest: InterestRegister):
-    if interest.cliente_id not in client_interests:
-        client_interests[interest.cliente_id] = set()
-    client_interests[interest.cliente_id].add(interest.leilao_id)
+    adicionar_interesse(interest.cliente_id, interest.leilao_id)
     return {"message": "Interesse registrado com sucesso"}
 
+@app.get("/interesses/{cliente_id}")
+async def obter_interesses_cliente(cliente_id: str):
+    return sorted(client_interests.get(cliente_id, ()))
+
+@app.post("/interesses/lote")
+async def alterar_interesses_lote(lote: InteressesLote):
+    """Assina e cancela vários leilões numa única requisição"""
+    adicionados = adicionar_interesses(lote.cliente_id, lote.adicionar)
+    removidos = remover_interesses(lote.cliente_id, lote.remover)
+    return {
+        "adicionados": len(adicionados),
+        "removidos": len(removidos),
+        "interesses": sorted(client_interests.get(lote.cliente_id, ()))
+    }
+
 @app.delete("/interesses/{cliente_id}/{leilao_id}")
 async def cancelar_interesse(cliente_id: str, leilao_id: str):
     if cliente_id in client_interests:
-        try:
-            client_interests[cliente_id].remove(leilao_id)
-        except KeyError:
+        if not remover_interesse(cliente_id, leilao_id):
             return {"error": "Interesse não encontrado"}, 404
     return {"message": "Interesse cancelado com sucesso"}
 
+@app.get("/sse/clientes")
+async def obter_atraso_clientes():
+    """Fila e atraso de cada conexão SSE aberta"""
+    return [conexao.metricas() for conexoes in sse_clients.values() for conexao in conexoes]
+
+def janela_em_segundos(janela_ms: Optional[int]) -> float:
+    janela_ms = JANELA_SSE_MS if janela_ms is None else janela_ms
+    return min(max(janela_ms, 0), JANELA_SSE_MAXIMA_MS) / 1000
+
+def negociar_compressao(accept_encoding: str) -> Optional[str]:
+    if not COMPRESSAO_SSE:
+        return None
+    aceitas = {codificacao.split(";")[0].strip().lower() for codificacao in accept_encoding.split(",")}
+    for codificacao in ("gzip", "deflate"):
+        if codificacao in aceitas:
+            return codificacao
+    return None
+
 @app.get("/eventos/{cliente_id}")
-async def sse_stream(cliente_id: str):
-    queue = asyncio.Queue()
-    sse_clients[cliente_id] = queue
+async def sse_stream(cliente_id: str, request: Request, ultimo_evento: Optional[str] = None,
+                     janela_ms: Optional[int] = None):
+    """
+    Stream SSE; Last-Event-ID (ou ?ultimo_evento=) reenvia os eventos perdidos desde a última conexão.
+    ?janela_ms= junta os eventos dessa janela num único write; gzip/deflate conforme Accept-Encoding.
+    """
+    janela = janela_em_segundos(janela_ms)
+    codificacao = negociar_compressao(request.headers.get("accept-encoding", ""))
+    # gzip usa cabeçalho gzip (wbits 16+); "deflate" em HTTP é o formato zlib
+    compressor = zlib.compressobj(wbits=zlib.MAX_WBITS | 16 if codificacao == "gzip" else zlib.MAX_WBITS) \
+        if codificacao else None
+
+    def saida(dados: bytes) -> bytes:
+        if compressor is None:
+            return dados
+        # Z_SYNC_FLUSH: cada write chega inteiro ao cliente sem esperar o fim do stream
+        return compressor.compress(dados) + compressor.flush(zlib.Z_SYNC_FLUSH)
+
+    conexao = ConexaoEventos(cliente_id)
+    conectar(cliente_id, conexao, request.headers.get("last-event-id") or ultimo_evento)
     
     async def event_generator():
         try:
             # Enviar evento de conexão estabelecida
-            yield f"data: {json.dumps({'type': 'connected', 'message': 'Conectado ao stream de eventos'})}\n\n"
+            yield saida(QUADRO_CONECTADO)
             
             while True:
-                if cliente_id not in client_interests or cliente_id not in sse_clients:
-                    del client_interests[cliente_id]
-                    del sse_clients[cliente_id]
+                eventos = await conexao.retirar(janela)
+                if not eventos:
                     break
-                event = await queue.get()
-                yield f"data: {json.dumps(event)}\n\n"
-        except asyncio.CancelledError:
-            if cliente_id in sse_clients:
-                del sse_clients[cliente_id]
-            if cliente_id in client_interests:
-                del client_interests[cliente_id]
+                # Quadros já serializados; um único write para tudo o que estava pendente
+                yield saida(b"".join(event.quadro for event in eventos))
+        finally:
+            # Cancelamento na desconexão ou fim do gerador: tira a conexão dos índices
+            desconectar(cliente_id, conexao)
     
+    headers = {
+        "Cache-Control": "no-cache",
+        "Connection": "keep-alive",
+        "X-Accel-Buffering": "no",
+        "Vary": "Accept-Encoding"
+    }
+    if codificacao:
+        headers["Content-Encoding"] = codificacao
     return StreamingResponse(
         event_generator(), 
         media_type="text/event-stream",
-        headers={
-            "Cache-Control": "no-cache",
-            "Connection": "keep-alive",
-            "X-Accel-Buffering": "no"
-        }
+        headers=headers
     )
 
+# ---- WebSocket ----
+def quadro_ws(itens: List[bytes]) -> bytes:
+    """Array JSON com vários eventos/respostas num único quadro binário"""
+    return b"[" + b",".join(itens) + b"]"
+
+@app.websocket("/ws/{cliente_id}")
+async def ws_stream(websocket: WebSocket, cliente_id: str, ultimo_evento: Optional[str] = None,
+                    janela_ms: Optional[int] = None):
+    """Assinaturas, lances e eventos multiplexados numa única conexão.
+
+    Cliente -> gateway: texto JSON com um comando ou uma lista de comandos
+        {"op": "sub" | "unsub", "leiloes": ["1", "2"]}
+        {"op": "lance", "ref": 7, "id_leilao": "1", "valor": 10.0, "ts": "..."}
+    Gateway -> cliente: quadros binários com um array JSON (UTF-8) de eventos e respostas
+    Na reconexão, ?ultimo_evento=<id> reenvia os eventos perdidos; ?janela_ms= junta eventos por quadro.
+    """
+    janela = janela_em_segundos(janela_ms)
+    await websocket.accept()
+    conexao = ConexaoEventos(cliente_id)
+    conectar(cliente_id, conexao, ultimo_evento)
+
+    async def enviar_eventos():
+        while True:
+            eventos = await conexao.retirar(janela)
+            if not eventos:
+                # Conexão lenta derrubada pela fila
+                await websocket.close(code=1008)
+                break
+            await websocket.send_bytes(quadro_ws([event.json for event in eventos]))
+
+    envio = asyncio.create_task(enviar_eventos())
+    try:
+        while True:
+            # Quadros de texto ou binários; receive_text() falharia com um quadro binário
+            mensagem = await websocket.receive()
+            if mensagem["type"] == "websocket.disconnect":
+                raise WebSocketDisconnect(mensagem.get("code", 1000))
+            try:
+                comandos = json.loads(mensagem.get("text") or mensagem.get("bytes") or b"")
+            except ValueError:
+                await websocket.send_bytes(quadro_ws([b'{"type":"erro","message":"JSON invalido"}']))
+                continue
+            if isinstance(comandos, dict):
+                comandos = [comandos]
+            elif not isinstance(comandos, list):
+                await websocket.send_bytes(quadro_ws([b'{"type":"erro","message":"Esperado um comando ou uma lista de comandos"}']))
+                continue
+
+            respostas, lances, refs = [], [], []
+            for comando in comandos:
+                op = comando.get("op") if isinstance(comando, dict) else None
+                leiloes = comando.get("leiloes", []) if op in ("sub", "unsub") else []
+                if op in ("sub", "unsub") and not isinstance(leiloes, list):
+                    respostas.append({"type": "erro", "message": f"{op}: 'leiloes' deve ser uma lista"})
+                elif op == "sub":
+                    adicionar_interesses(cliente_id, [str(leilao_id) for leilao_id in leiloes])
+                elif op == "unsub":
+                    remover_interesses(cliente_id, [str(leilao_id) for leilao_id in leiloes])
+                elif op == "lance":
+                    try:
+                        lances.append(LanceCreate(
+                            id_leilao=str(comando.get("id_leilao")),
+                            id_usuario=cliente_id,
+                            valor=comando.get("valor"),
+                            ts=comando.get("ts") or datetime.now().isoformat()
+                        ))
+                        refs.append(comando.get("ref"))
+                    except ValidationError as e:
+                        respostas.append({"type": "resposta", "ref": comando.get("ref"), "status": "error",
+                                          "codigo": 422, "message": str(e)})
+                else:
+                    respostas.append({"type": "erro", "message": f"Comando desconhecido: {op}"})
+
+            if lances:
+                # Todos os lances do quadro seguem num único lote por instância dona
+                try:
+                    resultados = await encaminhar_lances(lances)
+                except (httpx.HTTPError, UpstreamIndisponivel) as e:
+                    resultados = [{"status": "error", "codigo": 503, "message": str(e)}] * len(lances)
+                respostas.extend({"type": "resposta", "ref": ref, **resultado}
+                                 for ref, resultado in zip(refs, resultados))
+            if respostas:
+                await websocket.send_bytes(quadro_ws(
+                    [json.dumps(resposta, separators=(",", ":")).encode() for resposta in respostas]
+                ))
+    except WebSocketDisconnect:
+        pass
+    finally:
+        envio.cancel()
+        desconectar(cliente_id, conexao)
+
 # RabbitMQ Consumer
 def init_consumer():
     """Inicializa conexão e canal para consumo"""
-    global consumer_connection, consumer_channel
+    global consumer_connection, consumer_channel, consumer_queues
     consumer_connection = pika.BlockingConnection(pika.ConnectionParameters(host='localhost'))
     consumer_channel = consumer_connection.channel()
+    consumer_channel.basic_qos(prefetch_count=PREFETCH_BROKER)
     
-    # Declarar exchanges como direct
-    consumer_channel.exchange_declare(exchange='lance_validado', exchange_type=ExchangeType.direct, durable=True)
-    consumer_channel.exchange_declare(exchange='lance_invalidado', exchange_type=ExchangeType.direct, durable=True)
-    consumer_channel.exchange_declare(exchange='leilao_vencedor', exchange_type=ExchangeType.direct, durable=True)
-    consumer_channel.exchange_declare(exchange='link_pagamento', exchange_type=ExchangeType.direct, durable=True)
-    consumer_channel.exchange_declare(exchange='status_pagamento', exchange_type=ExchangeType.direct, durable=True)
+    # Lances, vencedores e pagamentos: exchange topic "<tipo>.<id_leilao>.<id_usuario>"
+    consumer_channel.exchange_declare(exchange=EXCHANGE_EVENTOS, exchange_type=ExchangeType.topic, durable=True)
+    # Eventos do MS Leilão que mantêm o cache de listagens
+    consumer_channel.exchange_declare(exchange='leilao_iniciado', exchange_type=ExchangeType.fanout, durable=False)
+    consumer_channel.exchange_declare(exchange='leilao_finalizado', exchange_type=ExchangeType.direct, durable=True)
     
-    events = ['lance_validado', 'lance_invalidado', 'leilao_vencedor', 
-              'link_pagamento', 'status_pagamento']
-    
-    for event in events:
+    consumer_queues = []
+    for event in EVENTOS:
         # Declare anonymous queue
         result = consumer_channel.queue_declare(queue='', exclusive=True)
         queue_name = result.method.queue
@@ -175,75 +1263,171 @@ def init_consumer():
             queue=queue_name,
             routing_key=event  # Use event name as routing key
         )
+        consumer_queues.append(queue_name)
+
+    # O broker só entrega o que algum cliente deste worker assina; após reconexão, refaz todos os bindings
+    global fila_eventos
+    fila_eventos = consumer_channel.queue_declare(queue='', exclusive=True).method.queue
+    for chave in list(ref_chaves):
+        consumer_channel.queue_bind(exchange=EXCHANGE_EVENTOS, queue=fila_eventos, routing_key=chave)
+    consumer_queues.append(fila_eventos)
+
+    if WORKERS_GATEWAY > 1:
+        consumer_channel.exchange_declare(exchange=EXCHANGE_CONTROLE, exchange_type=ExchangeType.fanout, durable=False)
+        result = consumer_channel.queue_declare(queue='', exclusive=True)
+        consumer_channel.queue_bind(exchange=EXCHANGE_CONTROLE, queue=result.method.queue)
+        consumer_queues.append(result.method.queue)
 
 def consume_rabbitmq_events():
-    """Consome eventos do RabbitMQ e notifica clientes SSE"""
-    global consumer_channel
-    
+    """Consome eventos do RabbitMQ e entrega ao event loop em lotes"""
+    lote = []
+
     def callback(ch, method, properties, body):
-        event_type = method.routing_key  # Get event type from routing key
-        event_data = json.loads(body.decode())
-        print(f"[API GATEWAY] Evento recebido: {event_type} - {event_data}")
-        asyncio.create_task(process_event(event_type, event_data))
-        ch.basic_ack(delivery_tag=method.delivery_tag)
-    
-    events = ['lance_validado', 'lance_invalidado', 'leilao_vencedor', 
-              'link_pagamento', 'status_pagamento']
-    
-    for event in events:
-        # Declare and bind anonymous queue
-        result = consumer_channel.queue_declare(queue='', exclusive=True)
-        queue_name = result.method.queue
-        consumer_channel.queue_bind(
-            exchange=event, 
-            queue=queue_name,
-            routing_key=event
-        )
-        
-        consumer_channel.basic_consume(
-            queue=queue_name,
-            on_message_callback=callback,
-            auto_ack=False
-        )
-    
-    print("[API GATEWAY] Consumidores RabbitMQ iniciados")
-    consumer_channel.start_consuming()
+        try:
+            event_data = json.loads(body)
+        except ValueError as e:
+            print(f"[API GATEWAY] Evento inválido descartado: {e}")
+            event_data = None
+        # Mesmo inválida, a mensagem entra no lote para que o ack cumulativo a cubra
+        # Na exchange topic o tipo é a primeira palavra da routing key; nas demais, o nome da exchange
+        if method.exchange == EXCHANGE_EVENTOS:
+            event_type = tipo_da_chave(method.routing_key)
+        else:
+            event_type = method.exchange
+        lote.append((event_type, event_data, method.delivery_tag))
 
-async def process_event(event_type: str, event_data: dict):
-    """Processa eventos e notifica clientes SSE interessados"""
-    for client_id, queue in list(sse_clients.items()):
+    while consumindo:
         try:
-            # Verificar se o cliente tem interesse no leilão
-            leilao_id = event_data.get('id_leilao')
-            usuario_id = event_data.get('id_usuario') or event_data.get('id_vencedor')
-            
-            should_notify = False
-            
-            if event_type in ['lance_invalidado', 'link_pagamento', 'status_pagamento']:
-                # Notificar apenas o usuário específico
-                should_notify = (str(client_id) == str(usuario_id))
-            elif event_type in ['lance_validado', 'leilao_vencedor']:
-                # Notificar todos os interessados no leilão
-                should_notify = (client_id in client_interests and 
-                               leilao_id in client_interests[client_id])
-            
-            if should_notify:
-                await queue.put({
-                    "type": event_type,
-                    "data": event_data,
-                    "timestamp": datetime.now().isoformat()
-                })
-                print(f"[API GATEWAY] Evento {event_type} notificado para cliente {client_id}")
+            if consumer_connection is None or consumer_connection.is_closed:
+                init_consumer()
+                metricas_broker["reconexoes"] += 1
+            for queue_name in consumer_queues:
+                consumer_channel.basic_consume(
+                    queue=queue_name,
+                    on_message_callback=callback,
+                    auto_ack=False
+                )
+            print("[API GATEWAY] Consumidores RabbitMQ iniciados")
+
+            while consumindo:
+                # Bloqueia até a primeira mensagem e depois drena o que já chegou no socket
+                consumer_connection.process_data_events(time_limit=None)
+                consumer_connection.process_data_events(time_limit=0)
+                if lote:
+                    loop_principal.call_soon_threadsafe(entregar_lote, lote[:])
+                    lote.clear()
+        except pika.exceptions.AMQPError as e:
+            print(f"[API GATEWAY] Conexão com RabbitMQ perdida: {e}")
+            # Mensagens sem ack voltam para a fila no broker
+            lote.clear()
+            try:
+                consumer_connection.close()
+            except Exception:
+                pass
+            time.sleep(INTERVALO_RECONEXAO)
+
+    if consumer_connection and not consumer_connection.is_closed:
+        consumer_connection.close()
+
+def entregar_lote(lote):
+    """Roda no event loop: enfileira o lote nas conexões e só então confirma ao broker com um ack cumulativo"""
+    for event_type, event_data, _ in lote:
+        if event_data is None:
+            metricas_broker["descartados"] += 1
+            continue
+        try:
+            process_event(event_type, event_data)
         except Exception as e:
-            print(f"[API GATEWAY] Erro ao notificar cliente {client_id}: {e}")
+            # Um evento malformado não pode impedir o resto do lote nem o ack
+            metricas_broker["descartados"] += 1
+            print(f"[API GATEWAY] Evento {event_type} descartado: {e!r}")
+    metricas_broker["lotes"] += 1
+    metricas_broker["eventos"] += len(lote)
+
+    conexao, canal, ultima = consumer_connection, consumer_channel, lote[-1][2]
+    try:
+        conexao.add_callback_threadsafe(lambda: canal.basic_ack(delivery_tag=ultima, multiple=True))
+    except Exception as e:
+        # Conexão caiu antes do ack: o broker reentrega o lote após a reconexão
+        print(f"[API GATEWAY] Falha ao confirmar lote: {e}")
+
+# leilao_id -> maior seq de lance_validado já entregue
+ultimo_seq_lance: Dict[str, int] = {}
+
+def process_event(event_type: str, event_data: dict):
+    """Processa eventos e notifica clientes SSE interessados; custo proporcional aos interessados"""
+    if event_type in ('leilao_iniciado', 'leilao_finalizado'):
+        cache_leiloes.aplicar(event_type, event_data)
+        if event_type == 'leilao_finalizado':
+            ultimo_seq_lance.pop(str(event_data["id"]), None)
+            agendar_limpeza(str(event_data["id"]))
+        return
+    if event_type == EXCHANGE_CONTROLE:
+        aplicar_controle(event_data)
+        return
+
+    leilao_id = event_data.get('id_leilao')
+    usuario_id = event_data.get('id_usuario') or event_data.get('id_vencedor')
+
+    if event_type == 'lance_validado' and event_data.get('seq') is not None:
+        # O MS Lance publica fora do lock: um lance mais antigo pode chegar depois de um mais novo
+        if event_data['seq'] <= ultimo_seq_lance.get(leilao_id, 0):
+            metricas_broker["descartados"] += 1
+            return
+        ultimo_seq_lance[leilao_id] = event_data['seq']
+
+    if event_type in ['lance_invalidado', 'link_pagamento', 'status_pagamento']:
+        # Notificar apenas o usuário específico, se conectado ou dentro da carência
+        usuario_id = str(usuario_id)
+        if usuario_id not in sse_clients and usuario_id not in em_graca:
+            return
+        destinatarios = [usuario_id]
+        replay, chave = replay_usuarios, usuario_id
+    elif event_type in ['lance_validado', 'leilao_vencedor']:
+        # Notificar os interessados no leilão com conexão (ou carência) neste worker
+        destinatarios = [
+            client_id for client_id in interessados_por_leilao.get(leilao_id, ())
+            if client_id in sse_clients or client_id in em_graca
+        ]
+        if not destinatarios:
+            return
+        replay, chave = replay_leiloes, leilao_id
+    else:
+        return
+
+    # Serializado uma vez para todas as conexões e para o anel de reenvio
+    event = EventoCodificado(event_type, leilao_id, event_data)
+    replay.registrar(chave, event)
+    for client_id in list(destinatarios):
+        for conexao in list(sse_clients.get(client_id, ())):
+            try:
+                conexao.colocar(event_type, leilao_id, event)
+            except Exception as e:
+                print(f"[API GATEWAY] Erro ao notificar cliente {client_id}: {e}")
 
 @app.on_event("startup")
 async def startup_event():
     """Inicializa consumidor RabbitMQ ao iniciar a aplicação"""
+    # Pools abertos antes do primeiro request: a primeira requisição já encontra o cliente pronto
+    upstream(LEILAO_SERVICE_URL)
+    for url in anel_lance.instancias.values():
+        upstream(url)
+
+    global loop_principal, consumindo, tarefa_manutencao
+    loop_principal = asyncio.get_running_loop()
+    consumindo = True
+    tarefa_manutencao = asyncio.create_task(manter_conexoes())
+
+    repositorio_interesses.abrir(GATEWAY_DB)
+    carregar_interesses()
+    asyncio.create_task(limpar_interesses_encerrados())
+    # Um worker que sobe depois de um PUT /lance/membros não recebeu a mensagem de controle
+    asyncio.create_task(sincronizar_anel_lance())
+
     print("[API GATEWAY] Inicializando consumidor RabbitMQ...")
     init_consumer()
     
-    # Iniciar consumidor RabbitMQ em thread separada
+    # Iniciar consumidor RabbitMQ em thread separada; eventos voltam ao loop por call_soon_threadsafe
     rabbitmq_thread = threading.Thread(target=consume_rabbitmq_events, daemon=True)
     rabbitmq_thread.start()
     print("[API GATEWAY] Consumidor RabbitMQ iniciado")
@@ -251,11 +1435,23 @@ async def startup_event():
 @app.on_event("shutdown")
 async def shutdown_event():
     """Fecha conexões ao encerrar a aplicação"""
+    global consumindo
     print("[API GATEWAY] Encerrando...")
+    consumindo = False
+    if tarefa_manutencao:
+        tarefa_manutencao.cancel()
     if consumer_connection and not consumer_connection.is_closed:
-        consumer_connection.close()
+        # A conexão pertence à thread consumidora: só acorda o loop dela, que fecha ao sair
+        consumer_connection.add_callback_threadsafe(lambda: None)
+    await fechar_upstreams(list(upstreams))
+    repositorio_interesses.fechar()
     print("[API GATEWAY] Conexões fechadas")
 
 if __name__ == "__main__":
     print("[API GATEWAY] API Gateway iniciado")
-    uvicorn.run(app, host="0.0.0.0", port=8003)
\ No newline at end of file
+    if WORKERS_GATEWAY > 1:
+        # Workers precisam importar o app por nome; interesses são replicados entre eles pelo broker
+        uvicorn.run("api_gateway:app", app_dir=os.path.dirname(os.path.abspath(__file__)),
+                    host="0.0.0.0", port=8003, workers=WORKERS_GATEWAY)
+    else:
+        uvicorn.run(app, host="0.0.0.0", port=8003)
\ No newline at end of file
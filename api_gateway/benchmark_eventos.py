@@ -0,0 +1,81 @@
+# Benchmark do fan-out de eventos do API Gateway (sem RabbitMQ nem rede).
+#
+# Mede, por evento de leilão, o custo de serializar uma vez (EventoCodificado)
+# e o de process_event inteiro para 100, 1k e 10k assinantes do mesmo leilão.
+# A serialização deve ficar constante; o que cresce com os assinantes é só o
+# enfileiramento. Para comparação, mede também o caminho anterior (um dict e
+# um json.dumps por cliente).
+#
+# Uso, a partir da raiz do repositório:
+#   python -m api_gateway.benchmark_eventos
+
+import json
+import time
+from datetime import datetime
+
+from api_gateway import api_gateway as gateway
+
+ASSINANTES = (100, 1_000, 10_000)
+EVENTOS = 50
+REPETICOES_CODIFICACAO = 10_000
+
+DADOS = {'id_leilao': 'L1', 'id_usuario': 'u1', 'valor': 123.45, 'ts': '2026-10-17T10:00:00'}
+
+
+def preparar(assinantes: int):
+    """Conexões locais interessadas em L1, como se tivessem aberto /eventos"""
+    gateway.sse_clients.clear()
+    gateway.client_interests.clear()
+    gateway.interessados_por_leilao.clear()
+    conexoes = []
+    for i in range(assinantes):
+        cliente_id = f"c{i}"
+        conexao = gateway.ConexaoEventos(cliente_id)
+        gateway.sse_clients[cliente_id] = {conexao}
+        gateway.adicionar_interesse(cliente_id, 'L1', propagar=False)
+        conexoes.append(conexao)
+    return conexoes
+
+
+def medir_codificacao() -> float:
+    """Microssegundos para serializar um evento (independe dos assinantes)"""
+    inicio = time.perf_counter()
+    for _ in range(REPETICOES_CODIFICACAO):
+        gateway.EventoCodificado('leilao_vencedor', 'L1', DADOS)
+    return (time.perf_counter() - inicio) / REPETICOES_CODIFICACAO * 1e6
+
+
+def medir_process_event(conexoes) -> float:
+    """Milissegundos de process_event por evento; as filas são esvaziadas fora da medição"""
+    total = 0.0
+    for _ in range(EVENTOS):
+        inicio = time.perf_counter()
+        gateway.process_event('leilao_vencedor', DADOS)
+        total += time.perf_counter() - inicio
+        for conexao in conexoes:
+            conexao.fila.clear()
+    return total / EVENTOS * 1e3
+
+
+def medir_caminho_anterior(assinantes: int) -> float:
+    """Milissegundos por evento serializando um dict por cliente"""
+    inicio = time.perf_counter()
+    for _ in range(EVENTOS):
+        for _ in range(assinantes):
+            evento = {"type": 'leilao_vencedor', "data": DADOS, "timestamp": datetime.now().isoformat()}
+            f"data: {json.dumps(evento)}\n\n".encode()
+    return (time.perf_counter() - inicio) / EVENTOS * 1e3
+
+
+def main():
+    print(f"Serialização única: {medir_codificacao():.1f} µs por evento")
+    print(f"{'assinantes':>10} {'process_event':>14} {'por assinante':>14} {'caminho anterior':>17}")
+    for assinantes in ASSINANTES:
+        conexoes = preparar(assinantes)
+        atual = medir_process_event(conexoes)
+        anterior = medir_caminho_anterior(assinantes)
+        print(f"{assinantes:>10} {atual:>11.2f} ms {atual * 1e3 / assinantes:>11.2f} µs {anterior:>14.2f} ms")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,61 @@
+# Benchmark do HistoricoLances (sem RabbitMQ nem rede).
+#
+# Registra 1M lances crescentes de 5k usuários e mede a memória dos arrays
+# tipados e o tempo médio de registrar(); depois, o tempo das consultas de
+# top-K, "desde ts" e ranking de um usuário. São os números citados na
+# docstring da classe.
+#
+# Uso, a partir da raiz do repositório:
+#   python -m lance.benchmark_historico
+
+import random
+import sys
+import time
+
+from lance.lance import HistoricoLances
+
+LANCES = 1_000_000
+USUARIOS = 5_000
+CONSULTAS = 10_000
+
+
+def bytes_dos_arrays(historico: HistoricoLances) -> int:
+    """Memória efetivamente alocada pelos arrays (inclui a folga de crescimento)"""
+    arrays = (historico.usuarios, historico.valores, historico.timestamps, historico._fenwick)
+    return sum(sys.getsizeof(a) for a in arrays)
+
+
+def main():
+    gerador = random.Random(42)
+    usuarios = [gerador.randrange(USUARIOS) for _ in range(LANCES)]
+    historico = HistoricoLances()
+
+    inicio = time.perf_counter()
+    ts = time.time()
+    for i, id_usuario in enumerate(usuarios):
+        historico.registrar(id_usuario, float(i + 1), ts + i * 0.001)
+    duracao = time.perf_counter() - inicio
+
+    memoria = bytes_dos_arrays(historico)
+    print(f"{LANCES} lances de {USUARIOS} usuários")
+    print(f"registrar(): {duracao / LANCES * 1e6:.1f} µs por lance")
+    print(f"arrays: {memoria / 1e6:.1f} MB ({memoria / LANCES:.1f} B por lance)")
+
+    inicio = time.perf_counter()
+    for _ in range(CONSULTAS):
+        historico.top(10)
+    print(f"top(10): {(time.perf_counter() - inicio) / CONSULTAS * 1e6:.1f} µs")
+
+    inicio = time.perf_counter()
+    for _ in range(CONSULTAS):
+        historico.desde(ts + gerador.randrange(LANCES) * 0.001, 100)
+    print(f"desde(ts, 100): {(time.perf_counter() - inicio) / CONSULTAS * 1e6:.1f} µs")
+
+    inicio = time.perf_counter()
+    for _ in range(CONSULTAS):
+        historico.do_usuario(gerador.randrange(USUARIOS))
+    print(f"do_usuario(): {(time.perf_counter() - inicio) / CONSULTAS * 1e6:.1f} µs")
+
+
+if __name__ == "__main__":
+    main()
@@ -10,79 +10,458 @@
 # termina, ele publica o evento na fila: leilao_finalizado.
 
 import pika
+import os
 import json
+import sqlite3
 import threading
 import time
+import heapq
+import itertools
+import base64
+from bisect import bisect_left, bisect_right
+from collections import deque
 from datetime import datetime, timedelta
 from pika.exchange_type import ExchangeType
 import uvicorn
 from model.leilao import Leilao, StatusLeilao
-from fastapi import FastAPI
+from fastapi import FastAPI, Request, Query
+from fastapi.encoders import jsonable_encoder
+from fastapi.responses import JSONResponse, Response
 from uuid import uuid4
-from pydantic import BaseModel
+from pydantic import BaseModel, field_validator
 from datetime import datetime
-from typing import Optional
+from typing import Optional, Literal, List
 
 app = FastAPI()
 
-leiloes = []
-timers_finalizacao = {}
+# Arquivo SQLite (modo WAL) com o estado durável dos leilões
+LEILAO_DB = os.environ.get("LEILAO_DB", "leilao.db")
 
-# Lock para sincronizar acesso ao RabbitMQ
-rabbitmq_lock = threading.Lock()
+# Tamanho máximo de página em GET /leilao
+LIMITE_MAXIMO_PAGINA = 1000
 
-# Conexão separada para publicação
-pub_connection = None
-pub_channel = None
+# Máximo de publicações aguardando confirmação do broker
+JANELA_CONFIRMACAO = int(os.environ.get("LEILAO_JANELA_CONFIRMACAO", "1000"))
 
+# Espera antes de reconectar o publicador ao RabbitMQ (segundos)
+INTERVALO_RECONEXAO = 2.0
 
-def init_publisher():
-    """Inicializa conexão e canal para publicação"""
-    global pub_connection, pub_channel
-    pub_connection = pika.BlockingConnection(pika.ConnectionParameters(host='localhost'))
-    pub_channel = pub_connection.channel()
-    
-    pub_channel.exchange_declare(exchange='leilao_iniciado', exchange_type=ExchangeType.fanout, durable=False)
-    pub_channel.exchange_declare(exchange='leilao_finalizado', exchange_type='direct', durable=True)
 
+# ---- Publicação com confirmação do broker ----
+class PublicadorEventos:
+    """
+    Publica os eventos da outbox em uma thread própria (SelectConnection),
+    com publisher confirms e no máximo JANELA_CONFIRMACAO mensagens em voo.
 
-def publicar_evento(exchange, routing_key, evento):
-    """Função thread-safe para publicar eventos no RabbitMQ"""
-    global pub_connection, pub_channel
-    with rabbitmq_lock:
+    Os eventos chegam em lotes já gravados na outbox do SQLite; só saem de lá
+    quando o broker confirma. Nacks e mensagens em voo numa queda de conexão
+    voltam para o início da fila e são reenviados.
+    """
+
+    def __init__(self, ao_confirmar):
+        self._ao_confirmar = ao_confirmar  # recebe os seqs confirmados
+        self._lock = threading.Lock()
+        self._pendentes = deque()  # (seq, exchange, routing_key, corpo)
+        self._em_voo = {}  # delivery_tag -> item
+        self._proxima_tag = 1
+        self._conexao = None
+        self._canal = None
+        self._pronto = False
+        self._drenagem_agendada = False
+        self._rodando = False
+        self._thread = None
+
+        self.publicados = 0
+        self.confirmados = 0
+        self.reenviados = 0
+
+    def enfileirar(self, itens):
+        """Entrega itens da outbox para publicação (thread-safe)"""
+        if not itens:
+            return
+        with self._lock:
+            self._pendentes.extend(itens)
+        self._agendar_drenagem()
+
+    def _agendar_drenagem(self):
+        with self._lock:
+            if not self._pronto or self._drenagem_agendada:
+                return
+            self._drenagem_agendada = True
+            conexao = self._conexao
         try:
-            # Verifica se precisa reconectar
-            if pub_connection is None or pub_connection.is_closed or pub_channel is None or pub_channel.is_closed:
-                print(f"[LEILÃO] Reconectando ao RabbitMQ...")
-                init_publisher()
-            
-            pub_channel.basic_publish(
-                exchange=exchange,
-                routing_key=routing_key,
-                body=json.dumps(evento).encode('utf-8'),
-                properties=pika.BasicProperties(delivery_mode=2, content_type="application/json")
-            )
-            return True
-        except Exception as e:
-            print(f"[LEILÃO] Erro ao publicar evento: {e}")
-            # Tentar reconectar e publicar novamente
+            conexao.ioloop.add_callback_threadsafe(self._drenar)
+        except Exception:
+            with self._lock:
+                self._drenagem_agendada = False
+
+    def _drenar(self):
+        """Publica pendentes até encher a janela (roda no ioloop)"""
+        with self._lock:
+            self._drenagem_agendada = False
+            if not self._pronto:
+                return
+            lote = []
+            while self._pendentes and len(self._em_voo) + len(lote) < JANELA_CONFIRMACAO:
+                lote.append(self._pendentes.popleft())
+        for i, item in enumerate(lote):
+            _, exchange, routing_key, corpo = item
             try:
-                init_publisher()
-                pub_channel.basic_publish(
+                self._canal.basic_publish(
                     exchange=exchange,
                     routing_key=routing_key,
-                    body=json.dumps(evento).encode('utf-8'),
+                    body=corpo,
                     properties=pika.BasicProperties(delivery_mode=2, content_type="application/json")
                 )
-                return True
-            except Exception as e2:
-                print(f"[LEILÃO] Erro na segunda tentativa: {e2}")
-                return False
+            except Exception as e:
+                print(f"[LEILÃO] Erro ao publicar evento: {e}")
+                with self._lock:
+                    self._pendentes.extendleft(reversed(lote[i:]))
+                return
+            with self._lock:
+                self._em_voo[self._proxima_tag] = item
+                self._proxima_tag += 1
+            self.publicados += 1
+
+    def _confirmacao(self, frame):
+        metodo = frame.method
+        tag = metodo.delivery_tag
+        with self._lock:
+            if metodo.multiple:
+                tags = [t for t in self._em_voo if t <= tag]
+            else:
+                tags = [tag] if tag in self._em_voo else []
+            itens = [self._em_voo.pop(t) for t in tags]
+            if isinstance(metodo, pika.spec.Basic.Nack):
+                self._pendentes.extendleft(reversed(itens))
+                self.reenviados += len(itens)
+                itens = []
+        if itens:
+            self.confirmados += len(itens)
+            try:
+                self._ao_confirmar([item[0] for item in itens])
+            except Exception as e:
+                print(f"[LEILÃO] Erro ao limpar outbox: {e}")
+        self._drenar()
+
+    def _ao_abrir_conexao(self, conexao):
+        conexao.channel(on_open_callback=self._ao_abrir_canal)
+
+    def _ao_abrir_canal(self, canal):
+        self._canal = canal
+        canal.add_on_close_callback(lambda *_: self._conexao.close() if self._conexao.is_open else None)
+        canal.exchange_declare(exchange='leilao_iniciado', exchange_type=ExchangeType.fanout, durable=False)
+        canal.exchange_declare(exchange='leilao_finalizado', exchange_type=ExchangeType.direct, durable=True)
+        canal.confirm_delivery(self._confirmacao, callback=self._ao_ativar_confirmacao)
+
+    def _ao_ativar_confirmacao(self, _frame):
+        with self._lock:
+            self._proxima_tag = 1
+            self._pronto = True
+        print("[LEILÃO] Publicador conectado com confirmações")
+        self._drenar()
+
+    def _ao_perder_conexao(self, conexao, *_):
+        conexao.ioloop.stop()
+
+    def _loop(self):
+        while self._rodando:
+            try:
+                self._conexao = pika.SelectConnection(
+                    pika.ConnectionParameters(host='localhost'),
+                    on_open_callback=self._ao_abrir_conexao,
+                    on_open_error_callback=self._ao_perder_conexao,
+                    on_close_callback=self._ao_perder_conexao,
+                )
+                self._conexao.ioloop.start()
+            except Exception as e:
+                print(f"[LEILÃO] Erro no publicador: {e}")
+
+            # Sem conexão: o que não foi confirmado volta para a fila, em ordem
+            with self._lock:
+                self._pronto = False
+                self._drenagem_agendada = False
+                em_voo = [self._em_voo[t] for t in sorted(self._em_voo)]
+                self._em_voo.clear()
+                self._pendentes.extendleft(reversed(em_voo))
+                self.reenviados += len(em_voo)
+            if self._rodando:
+                print("[LEILÃO] Reconectando publicador ao RabbitMQ...")
+                time.sleep(INTERVALO_RECONEXAO)
+
+    def iniciar(self):
+        self._rodando = True
+        self._thread = threading.Thread(target=self._loop, name="publicador-eventos", daemon=True)
+        self._thread.start()
+
+    def parar(self):
+        self._rodando = False
+        conexao = self._conexao
+        if conexao is not None:
+            try:
+                conexao.ioloop.add_callback_threadsafe(conexao.close)
+            except Exception:
+                pass
+        if self._thread is not None:
+            self._thread.join(timeout=5)
+
+    def metricas(self):
+        with self._lock:
+            return {
+                "pendentes": len(self._pendentes),
+                "em_voo": len(self._em_voo),
+                "publicados": self.publicados,
+                "confirmados": self.confirmados,
+                "reenviados": self.reenviados,
+            }
+
+
+# ---- Armazenamento indexado dos leilões ----
+def data_local(valor: datetime) -> datetime:
+    """Datas com fuso viram hora local sem fuso, como o resto do serviço (datetime.now())"""
+    if valor.tzinfo is not None:
+        return valor.astimezone().replace(tzinfo=None)
+    return valor
+
+class RepositorioLeiloes:
+    """
+    Leilões em memória com índices: dict por id, buckets por status e listas
+    ordenadas por (inicio, id) e (fim, id) para consultas por janela de tempo
+    e paginação por cursor. `versao` muda a cada alteração e serve de ETag.
+
+    Depois de `abrir()`, toda alteração é gravada também em SQLite (WAL).
+    """
+
+    CAMPOS_ORDENADOS = ("inicio", "fim")
+
+    def __init__(self):
+        self._lock = threading.RLock()
+        self._por_id = {}
+        self._por_status = {status.value: set() for status in StatusLeilao}
+        self._ordenados = {campo: [] for campo in self.CAMPOS_ORDENADOS}
+        self._db = None
+        self._proximo_seq_outbox = 1
+        self.versao = 0
+
+    def abrir(self, caminho):
+        """Abre o banco, carregando os leilões já persistidos em uma só leitura"""
+        with self._lock:
+            self._db = sqlite3.connect(caminho, check_same_thread=False)
+            self._db.execute("PRAGMA journal_mode=WAL")
+            self._db.execute("PRAGMA synchronous=NORMAL")
+            self._db.execute(
+                "CREATE TABLE IF NOT EXISTS leiloes ("
+                "id TEXT PRIMARY KEY, descricao TEXT NOT NULL, "
+                "inicio TEXT NOT NULL, fim TEXT NOT NULL, status TEXT NOT NULL)"
+            )
+            self._db.execute(
+                "CREATE TABLE IF NOT EXISTS outbox ("
+                "seq INTEGER PRIMARY KEY, exchange TEXT NOT NULL, "
+                "routing_key TEXT NOT NULL, corpo BLOB NOT NULL)"
+            )
+            self._db.commit()
+            (maximo,) = self._db.execute("SELECT MAX(seq) FROM outbox").fetchone()
+            self._proximo_seq_outbox = (maximo or 0) + 1
+
+            for id_leilao, descricao, inicio, fim, status in self._db.execute(
+                "SELECT id, descricao, inicio, fim, status FROM leiloes"
+            ):
+                try:
+                    leilao = {
+                        "id": id_leilao,
+                        "descricao": descricao,
+                        "inicio": data_local(datetime.fromisoformat(inicio)),
+                        "fim": data_local(datetime.fromisoformat(fim)),
+                        "status": StatusLeilao(status).value
+                    }
+                except ValueError as e:
+                    # Uma linha corrompida não pode impedir o serviço de subir
+                    print(f"[LEILÃO] Leilão {id_leilao} ignorado na recuperação: {e}")
+                    continue
+                self._por_id[id_leilao] = leilao
+                self._por_status[leilao["status"]].add(id_leilao)
+            for campo, indice in self._ordenados.items():
+                indice.extend((leilao[campo], leilao["id"]) for leilao in self._por_id.values())
+                indice.sort()
+            self.versao += 1
+            return len(self._por_id)
+
+    def fechar(self):
+        with self._lock:
+            if self._db is not None:
+                self._db.close()
+                self._db = None
+
+    def _gravar(self, *operacoes):
+        """Executa cada (sql, linhas) em uma única transação"""
+        if self._db is None:
+            return
+        with self._db:
+            for sql, linhas in operacoes:
+                self._db.executemany(sql, linhas)
+
+    def outbox(self):
+        """Eventos gravados e ainda não confirmados pelo broker, em ordem"""
+        with self._lock:
+            if self._db is None:
+                return []
+            return self._db.execute("SELECT seq, exchange, routing_key, corpo FROM outbox ORDER BY seq").fetchall()
+
+    def remover_outbox(self, seqs):
+        with self._lock:
+            self._gravar(("DELETE FROM outbox WHERE seq = ?", [(seq,) for seq in seqs]))
+
+    @staticmethod
+    def _linha(leilao):
+        return (leilao["id"], leilao["descricao"], leilao["inicio"].isoformat(), leilao["fim"].isoformat(), leilao["status"])
+
+    def pendentes(self):
+        """Leilões ainda não encerrados (só percorre os buckets de status abertos)"""
+        with self._lock:
+            return [
+                self._por_id[i]
+                for status in (StatusLeilao.AGUARDANDO.value, StatusLeilao.ATIVO.value)
+                for i in self._por_status[status]
+            ]
+
+    def __len__(self):
+        return len(self._por_id)
+
+    def obter(self, id_leilao):
+        return self._por_id.get(id_leilao)
+
+    def inserir(self, leilao):
+        with self._lock:
+            # Posições calculadas antes de gravar: se a comparação falhar, nada foi persistido
+            posicoes = {
+                campo: bisect_right(indice, (leilao[campo], leilao["id"]))
+                for campo, indice in self._ordenados.items()
+            }
+            self._gravar(("INSERT INTO leiloes VALUES (?, ?, ?, ?, ?)", [self._linha(leilao)]))
+            self._por_id[leilao["id"]] = leilao
+            self._por_status[leilao["status"]].add(leilao["id"])
+            for campo, indice in self._ordenados.items():
+                indice.insert(posicoes[campo], (leilao[campo], leilao["id"]))
+            self.versao += 1
+
+    def inserir_lote(self, novos):
+        """Insere vários leilões com uma só ordenação de cada índice"""
+        with self._lock:
+            # Índices novos montados antes de gravar: se a ordenação falhar, nada foi persistido
+            indices = {}
+            for campo, indice in self._ordenados.items():
+                # Duas sequências já ordenadas: o Timsort apenas as intercala
+                indices[campo] = indice + sorted((leilao[campo], leilao["id"]) for leilao in novos)
+                indices[campo].sort()
+            self._gravar(("INSERT INTO leiloes VALUES (?, ?, ?, ?, ?)", [self._linha(l) for l in novos]))
+            for leilao in novos:
+                self._por_id[leilao["id"]] = leilao
+                self._por_status[leilao["status"]].add(leilao["id"])
+            self._ordenados = indices
+            self.versao += 1
+
+    def atualizar_status_lote(self, ids, status, eventos=()):
+        """
+        Atualiza o status de vários leilões e grava os eventos correspondentes
+        na outbox, tudo em uma única transação. Retorna os itens da outbox
+        (seq, exchange, routing_key, corpo) para o publicador.
+        """
+        with self._lock:
+            itens = []
+            for exchange, routing_key, corpo in eventos:
+                itens.append((self._proximo_seq_outbox, exchange, routing_key, corpo))
+                self._proximo_seq_outbox += 1
+            self._gravar(
+                ("UPDATE leiloes SET status = ? WHERE id = ?", [(status, i) for i in ids]),
+                ("INSERT INTO outbox VALUES (?, ?, ?, ?)", itens),
+            )
+            for id_leilao in ids:
+                leilao = self._por_id[id_leilao]
+                self._por_status[leilao["status"]].discard(id_leilao)
+                leilao["status"] = status
+                self._por_status[status].add(id_leilao)
+            self.versao += 1
+            return itens
+
+    @staticmethod
+    def codificar_cursor(chave):
+        valor, id_leilao = chave
+        return base64.urlsafe_b64encode(f"{valor.isoformat()}|{id_leilao}".encode()).decode()
+
+    @staticmethod
+    def decodificar_cursor(cursor):
+        valor, id_leilao = base64.urlsafe_b64decode(cursor.encode()).decode().split("|", 1)
+        return data_local(datetime.fromisoformat(valor)), id_leilao
+
+    def consultar(self, status=None, ordem="inicio", de=None, ate=None, cursor=None, limite=None):
+        """
+        Retorna (itens, proximo_cursor, versao) ordenados por `ordem`.
+        A janela [de, ate] se aplica ao campo de ordenação.
+        """
+        with self._lock:
+            indice = self._ordenados[ordem]
+            inicio = bisect_left(indice, (de,)) if de is not None else 0
+            if cursor is not None:
+                inicio = max(inicio, bisect_right(indice, self.decodificar_cursor(cursor)))
+            fim = bisect_right(indice, (ate, "\U0010ffff")) if ate is not None else len(indice)
+
+            if status is None:
+                chaves = indice[inicio:fim] if limite is None else indice[inicio:min(fim, inicio + limite + 1)]
+            else:
+                bucket = self._por_status[status]
+                if len(bucket) < fim - inicio:
+                    # Bucket menor que a janela: ordena só os leilões do status
+                    minimo = indice[inicio] if inicio < fim else None
+                    maximo = indice[fim - 1] if inicio < fim else None
+                    chaves = sorted(
+                        chave for chave in ((self._por_id[i][ordem], i) for i in bucket)
+                        if minimo is not None and minimo <= chave <= maximo
+                    )
+                else:
+                    chaves = [chave for chave in indice[inicio:fim] if self._por_id[chave[1]]["status"] == status]
+
+            proximo_cursor = None
+            if limite is not None and len(chaves) > limite:
+                chaves = chaves[:limite]
+                proximo_cursor = self.codificar_cursor(chaves[-1])
+
+            return [dict(self._por_id[i]) for _, i in chaves], proximo_cursor, self.versao
+
+
+repositorio = RepositorioLeiloes()
+publicador = PublicadorEventos(repositorio.remover_outbox)
 
 
 @app.get("/leilao")
-def get_leiloes():
-    return leiloes
+def get_leiloes(
+    request: Request,
+    status: Optional[StatusLeilao] = None,
+    ordem: Literal["inicio", "fim"] = "inicio",
+    de: Optional[datetime] = None,
+    ate: Optional[datetime] = None,
+    cursor: Optional[str] = None,
+    limite: Optional[int] = Query(None, ge=1, le=LIMITE_MAXIMO_PAGINA),
+):
+    """
+    Lista leilões filtrando por status e janela de tempo, com paginação por
+    cursor (cabeçalho X-Proximo-Cursor) e suporte a If-None-Match.
+    """
+    etag = f'W/"{repositorio.versao}"'
+    if etag in (tag.strip() for tag in request.headers.get("if-none-match", "").split(",")):
+        return Response(status_code=304, headers={"ETag": etag})
+
+    try:
+        itens, proximo_cursor, versao = repositorio.consultar(
+            status=status.value if status else None,
+            ordem=ordem, de=de and data_local(de), ate=ate and data_local(ate), cursor=cursor, limite=limite,
+        )
+    except ValueError:
+        return JSONResponse({"error": "Cursor inválido"}, status_code=400)
+
+    headers = {"ETag": f'W/"{versao}"'}
+    if proximo_cursor:
+        headers["X-Proximo-Cursor"] = proximo_cursor
+    return JSONResponse(jsonable_encoder(itens), headers=headers)
 
 
 class LeilaoCreate(BaseModel):
@@ -91,99 +470,361 @@ class LeilaoCreate(BaseModel):
     fim: datetime
     # status will be set internally, do not require on input
 
+    @field_validator("inicio", "fim")
+    @classmethod
+    def _data_local(cls, valor: datetime) -> datetime:
+        return data_local(valor)
+
 @app.post("/leilao")
 def criar_leilao(leilao: LeilaoCreate):
     try:
-        leiloes.append({
+        novo = {
             "id": uuid4().hex,
             "descricao": leilao.descricao,
             "inicio": leilao.inicio,
             "fim": leilao.fim,
             "status": StatusLeilao.AGUARDANDO.value
-        })
+        }
+        repositorio.inserir(novo)
     except Exception as e:
         return {"error": str(e)}
-    agendar_leiloes()
+    agendar_leilao(novo)
     return {"message": "Leilão criado com sucesso"}
 
 
-def iniciar_leilao(leilao):
-    """Inicia um leilão e publica evento leilao_iniciado"""
-    leilao["status"] = StatusLeilao.ATIVO.value
+@app.post("/leilao/batch")
+def criar_leiloes_lote(novos: List[LeilaoCreate]):
+    """Cria vários leilões com uma só inserção, um só agendamento e um só lote de leilao_iniciado"""
+    leiloes_criados = [
+        {
+            "id": uuid4().hex,
+            "descricao": leilao.descricao,
+            "inicio": leilao.inicio,
+            "fim": leilao.fim,
+            "status": StatusLeilao.AGUARDANDO.value
+        }
+        for leilao in novos
+    ]
+    repositorio.inserir_lote(leiloes_criados)
 
-    evento = {
+    agora = datetime.now()
+    agendamentos = []
+    imediatos = []
+    for leilao in leiloes_criados:
+        if leilao["fim"] > agora:
+            agendamentos.append((leilao["id"], FIM, leilao["fim"]))
+        if leilao["inicio"] > agora:
+            agendamentos.append((leilao["id"], INICIO, leilao["inicio"]))
+        else:
+            imediatos.append(leilao)
+    agendador.agendar_lote(agendamentos)
+    iniciar_leiloes(imediatos)
+
+    print(f"[LEILÃO] Lote de {len(leiloes_criados)} leilões criado ({len(imediatos)} iniciados imediatamente)")
+    return {
+        "message": "Leilões criados com sucesso",
+        "ids": [leilao["id"] for leilao in leiloes_criados]
+    }
+
+
+def evento_iniciado(leilao):
+    return {
         "id": leilao["id"],
         "descricao": leilao["descricao"],
         "inicio": leilao["inicio"].isoformat(),
         "fim": leilao["fim"].isoformat(),
-        "status": leilao["status"]
+        "status": StatusLeilao.ATIVO.value
     }
-    
-    if publicar_evento('leilao_iniciado', 'leilao_iniciado', evento):
-        print(f"[LEILÃO] Iniciado leilão {leilao['id']}: {leilao['descricao']}")
+
+
+def iniciar_leiloes(leiloes):
+    """Inicia leilões e grava um leilao_iniciado por leilão na outbox, em uma só transação"""
+    if not leiloes:
+        return
+    eventos = [
+        ('leilao_iniciado', 'leilao_iniciado', json.dumps(evento_iniciado(leilao)).encode('utf-8'))
+        for leilao in leiloes
+    ]
+    itens = repositorio.atualizar_status_lote([leilao["id"] for leilao in leiloes], StatusLeilao.ATIVO.value, eventos)
+    publicador.enfileirar(itens)
+    if len(leiloes) == 1:
+        print(f"[LEILÃO] Iniciado leilão {leiloes[0]['id']}: {leiloes[0]['descricao']}")
     else:
-        print(f"[LEILÃO] ERRO ao iniciar leilão {leilao['id']}")
+        print(f"[LEILÃO] Iniciados {len(leiloes)} leilões")
 
 
-def finalizar_leilao(leilao):
-    """Finaliza um leilão e publica evento leilao_finalizado"""
-    leilao["status"] = StatusLeilao.ENCERRADO.value
-    
-    evento = {
-        "id": leilao["id"]
-    }
-    
-    if publicar_evento('leilao_finalizado', 'leilao_finalizado', evento):
-        print(f"[LEILÃO] Finalizado leilão {leilao['id']}: {leilao['descricao']}")
+def finalizar_leiloes(leiloes):
+    """Finaliza leilões e grava um leilao_finalizado por leilão na outbox, em uma só transação"""
+    if not leiloes:
+        return
+    eventos = [
+        ('leilao_finalizado', 'leilao_finalizado', json.dumps({"id": leilao["id"]}).encode('utf-8'))
+        for leilao in leiloes
+    ]
+    itens = repositorio.atualizar_status_lote([leilao["id"] for leilao in leiloes], StatusLeilao.ENCERRADO.value, eventos)
+    publicador.enfileirar(itens)
+    if len(leiloes) == 1:
+        print(f"[LEILÃO] Finalizado leilão {leiloes[0]['id']}: {leiloes[0]['descricao']}")
+    else:
+        print(f"[LEILÃO] Finalizados {len(leiloes)} leilões")
+
+
+# ---- Agendador de início/fim dos leilões ----
+INICIO = 0
+FIM = 1
+
+
+class AgendadorLeiloes:
+    """
+    Agendador único baseado em min-heap de prazos de início/fim.
+
+    Uma só thread dorme até o prazo mais próximo, em vez de um threading.Timer
+    por leilão. Inserção é O(log n); o cancelamento marca a entrada e ela é
+    descartada quando chega ao topo (o heap é compactado se o lixo passar da
+    metade). Todos os prazos vencidos juntos são entregues em um único
+    disparar([(id_leilao, tipo), ...]).
+    """
+
+    def __init__(self, disparar):
+        self._disparar = disparar
+        self._heap = []
+        self._entradas = {}  # (id_leilao, tipo) -> entrada do heap
+        self._cond = threading.Condition()
+        self._seq = itertools.count()
+        self._cancelados = 0
+        self._rodando = False
+        self._thread = None
+
+        # Métricas de pontualidade dos disparos
+        self.disparos = 0
+        self.atraso_ultimo = 0.0
+        self.atraso_max = 0.0
+        self._atraso_soma = 0.0
+
+    def agendar(self, id_leilao, tipo, quando):
+        """Agenda o início/fim de um leilão para o instante `quando` (datetime)"""
+        self.agendar_lote([(id_leilao, tipo, quando)])
+
+    def agendar_lote(self, itens):
+        """Agenda vários (id_leilao, tipo, quando) de uma vez"""
+        agora_relogio = datetime.now()
+        agora = time.monotonic()
+        # Listas mutáveis para permitir o cancelamento preguiçoso
+        novas = [
+            [agora + (quando - agora_relogio).total_seconds(), tipo, next(self._seq), id_leilao, True]
+            for id_leilao, tipo, quando in itens
+        ]
+        if not novas:
+            return
+        with self._cond:
+            topo = self._heap[0] if self._heap else None
+            for entrada in novas:
+                anterior = self._entradas.pop((entrada[3], entrada[1]), None)
+                if anterior is not None:
+                    anterior[-1] = False
+                    self._cancelados += 1
+                self._entradas[(entrada[3], entrada[1])] = entrada
+            if len(novas) > len(self._heap):
+                self._heap.extend(novas)
+                heapq.heapify(self._heap)
+            else:
+                for entrada in novas:
+                    heapq.heappush(self._heap, entrada)
+            # Só acorda a thread se o prazo mais próximo mudou
+            if self._heap[0] is not topo:
+                self._cond.notify()
+
+    def cancelar(self, id_leilao, tipo=None):
+        """Cancela o início e/ou fim agendado de um leilão"""
+        tipos = (INICIO, FIM) if tipo is None else (tipo,)
+        with self._cond:
+            for t in tipos:
+                entrada = self._entradas.pop((id_leilao, t), None)
+                if entrada is not None:
+                    entrada[-1] = False
+                    self._cancelados += 1
+            if self._cancelados > len(self._heap) // 2:
+                self._compactar()
+
+    def _compactar(self):
+        self._heap = [e for e in self._heap if e[-1]]
+        heapq.heapify(self._heap)
+        self._cancelados = 0
+
+    def _proximos_vencidos(self):
+        """Bloqueia até haver prazos vencidos e os retira do heap"""
+        with self._cond:
+            while self._rodando:
+                while self._heap and not self._heap[0][-1]:
+                    heapq.heappop(self._heap)
+                    self._cancelados -= 1
+                if not self._heap:
+                    self._cond.wait()
+                    continue
+                espera = self._heap[0][0] - time.monotonic()
+                if espera > 0:
+                    self._cond.wait(espera)
+                    continue
+
+                agora = time.monotonic()
+                vencidos = []
+                while self._heap and self._heap[0][0] <= agora:
+                    entrada = heapq.heappop(self._heap)
+                    if not entrada[-1]:
+                        self._cancelados -= 1
+                        continue
+                    del self._entradas[(entrada[3], entrada[1])]
+                    vencidos.append(entrada)
+                return vencidos
+            return []
+
+    def _loop(self):
+        while self._rodando:
+            vencidos = self._proximos_vencidos()
+            if not vencidos:
+                continue
+            agora = time.monotonic()
+            for prazo, *_ in vencidos:
+                atraso = agora - prazo
+                self.atraso_max = max(self.atraso_max, atraso)
+                self._atraso_soma += atraso
+            self.atraso_ultimo = agora - vencidos[-1][0]
+            self.disparos += len(vencidos)
+            try:
+                self._disparar([(id_leilao, tipo) for _, tipo, _, id_leilao, _ in vencidos])
+            except Exception as e:
+                print(f"[LEILÃO] Erro no disparo de {len(vencidos)} prazos agendados: {e}")
+
+    def iniciar(self):
+        with self._cond:
+            if self._rodando:
+                return
+            self._rodando = True
+        self._thread = threading.Thread(target=self._loop, name="agendador-leiloes", daemon=True)
+        self._thread.start()
+
+    def parar(self):
+        with self._cond:
+            self._rodando = False
+            self._cond.notify_all()
+        if self._thread is not None:
+            self._thread.join(timeout=5)
+
+    def metricas(self):
+        with self._cond:
+            pendentes = len(self._entradas)
+            tamanho_heap = len(self._heap)
+        return {
+            "pendentes": pendentes,
+            "tamanho_heap": tamanho_heap,
+            "disparos": self.disparos,
+            "atraso_ultimo_ms": round(self.atraso_ultimo * 1000, 3),
+            "atraso_max_ms": round(self.atraso_max * 1000, 3),
+            "atraso_medio_ms": round(self._atraso_soma / self.disparos * 1000, 3) if self.disparos else 0.0,
+        }
+
+
+def disparar_vencidos(vencidos):
+    """Inicia e finaliza, cada um em um lote, os leilões cujos prazos venceram juntos"""
+    iniciar_leiloes([repositorio.obter(id_leilao) for id_leilao, tipo in vencidos if tipo == INICIO])
+    finalizar_leiloes([repositorio.obter(id_leilao) for id_leilao, tipo in vencidos if tipo == FIM])
+
+
+agendador = AgendadorLeiloes(disparar_vencidos)
+
+
+def agendar_leilao(leilao):
+    """Agenda o início e o fim de um leilão recém-criado"""
+    agora = datetime.now()
+
+    if leilao["fim"] > agora:
+        agendador.agendar(leilao["id"], FIM, leilao["fim"])
+        print(f"[LEILÃO] Agendado fim do leilão {leilao['id']} em {(leilao['fim'] - agora).total_seconds():.1f}s")
+
+    if leilao["inicio"] > agora:
+        agendador.agendar(leilao["id"], INICIO, leilao["inicio"])
+        print(f"[LEILÃO] Agendado início do leilão {leilao['id']} em {(leilao['inicio'] - agora).total_seconds():.1f}s")
     else:
-        print(f"[LEILÃO] ERRO ao finalizar leilão {leilao['id']}")
+        print(f"[LEILÃO] Iniciando leilão {leilao['id']} imediatamente")
+        iniciar_leiloes([leilao])
+
+
+@app.get("/agendador")
+def get_agendador():
+    """Profundidade da fila de prazos, atraso dos disparos, publicador e última recuperação"""
+    return {
+        **agendador.metricas(),
+        "publicador": publicador.metricas(),
+        "recuperacao": metricas_recuperacao,
+    }
 
 
-def agendar_leiloes():
-    """Agenda o início de todos os leilões"""
+# Medições da última recuperação após reinício
+metricas_recuperacao = {}
+
+
+def recuperar_estado():
+    """
+    Recarrega os leilões do SQLite, reconstrói o agendamento e publica uma
+    única vez os inícios/fins cujo prazo passou com o serviço parado.
+    """
+    t0 = time.perf_counter()
+    total = repositorio.abrir(LEILAO_DB)
+    t_carga = time.perf_counter() - t0
+
+    # Eventos gravados antes da queda e nunca confirmados saem primeiro
+    nao_confirmados = repositorio.outbox()
+    publicador.enfileirar(nao_confirmados)
+
     agora = datetime.now()
-    
-    for leilao in leiloes:
-        # Verifica se já foi agendado
-        if leilao["id"] in timers_finalizacao:
-            continue
-            
-        tempo_para_inicio = (leilao["inicio"] - agora).total_seconds()
-        tempo_para_fim = (leilao["fim"] - agora).total_seconds()
-        
-        if tempo_para_fim > 0:
-            timer_fim = threading.Timer(tempo_para_fim, finalizar_leilao, args=[leilao])
-            timer_fim.start()
-            timers_finalizacao[leilao["id"]] = timer_fim
-            print(f"[LEILÃO] Agendado fim do leilão {leilao['id']} em {tempo_para_fim:.1f}s")
-        
-        if tempo_para_inicio > 0:
-            timer_inicio = threading.Timer(tempo_para_inicio, iniciar_leilao, args=[leilao])
-            timer_inicio.start()
-            print(f"[LEILÃO] Agendado início do leilão {leilao['id']} em {tempo_para_inicio:.1f}s")
+    agendamentos = []
+    inicios_perdidos = []
+    fins_perdidos = []
+    for leilao in repositorio.pendentes():
+        if leilao["status"] == StatusLeilao.AGUARDANDO.value:
+            if leilao["inicio"] > agora:
+                agendamentos.append((leilao["id"], INICIO, leilao["inicio"]))
+            else:
+                inicios_perdidos.append(leilao)
+        if leilao["fim"] > agora:
+            agendamentos.append((leilao["id"], FIM, leilao["fim"]))
         else:
-            print(f"[LEILÃO] Iniciando leilão {leilao['id']} imediatamente")
-            iniciar_leilao(leilao)
+            fins_perdidos.append(leilao)
+    agendador.agendar_lote(agendamentos)
+
+    iniciar_leiloes(inicios_perdidos)
+    finalizar_leiloes(fins_perdidos)
+
+    metricas_recuperacao.update({
+        "leiloes": total,
+        "outbox_reenviados": len(nao_confirmados),
+        "agendados": len(agendamentos),
+        "inicios_perdidos": len(inicios_perdidos),
+        "fins_perdidos": len(fins_perdidos),
+        "carga_ms": round(t_carga * 1000, 1),
+        "total_ms": round((time.perf_counter() - t0) * 1000, 1),
+    })
+    print(f"[LEILÃO] Estado recuperado: {metricas_recuperacao}")
 
 
 @app.on_event("startup")
 async def startup_event():
-    """Inicializa publisher quando a aplicação inicia"""
+    """Recupera o estado e inicializa publisher e agendador quando a aplicação inicia"""
+    recuperar_estado()
     print("[LEILÃO] Inicializando publisher...")
-    init_publisher()
+    publicador.iniciar()
     print("[LEILÃO] Publisher inicializado")
+    agendador.iniciar()
+    print("[LEILÃO] Agendador iniciado")
 
 
 @app.on_event("shutdown")
 async def shutdown_event():
     """Fecha conexões quando a aplicação encerra"""
     print("\n[LEILÃO] Parando microsserviço...")
-    for timer in timers_finalizacao.values():
-        if timer.is_alive():
-            timer.cancel()
-    with rabbitmq_lock:
-        if pub_connection and not pub_connection.is_closed:
-            pub_connection.close()
+    agendador.parar()
+    publicador.parar()
+    repositorio.fechar()
     print("[LEILÃO] Microsserviço parado")
 
 
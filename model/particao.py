@@ -0,0 +1,60 @@
+import hashlib
+from bisect import bisect_right
+from dataclasses import dataclass, field
+
+# Fixed number of partitions; auctions map to partitions, partitions map to instances
+NUM_PARTICOES = 256
+
+def _hash(chave: str) -> int:
+    """Stable hash, identical across processes (unlike the builtin hash)"""
+    return int.from_bytes(hashlib.md5(chave.encode('utf-8')).digest()[:8], 'big')
+
+def particao_do_leilao(id_leilao: str) -> int:
+    """Partition that owns an auction"""
+    return _hash(id_leilao) % NUM_PARTICOES
+
+@dataclass
+class AnelConsistente:
+    instancias: dict  # id_instancia -> base URL
+    versao: int = 0
+    vnodes: int = 64
+    _donos: list = field(default_factory=list, init=False, repr=False)
+
+    def __post_init__(self):
+        """Place each instance on the ring and precompute the owner of every partition"""
+        anel = sorted(
+            (_hash(f"{id_instancia}#{i}"), id_instancia)
+            for id_instancia in self.instancias
+            for i in range(self.vnodes)
+        )
+        pontos = [ponto for ponto, _ in anel]
+        self._donos = [
+            anel[bisect_right(pontos, _hash(f"particao-{p}")) % len(anel)][1] if anel else None
+            for p in range(NUM_PARTICOES)
+        ]
+
+    @classmethod
+    def from_config(cls, config: str, versao: int = 0):
+        """Create a ring from 'id=url,id=url'"""
+        instancias = {}
+        for item in config.split(','):
+            if item.strip():
+                id_instancia, url = item.split('=', 1)
+                instancias[id_instancia.strip()] = url.strip()
+        return cls(instancias=instancias, versao=versao)
+
+    def dono_particao(self, particao: int) -> str | None:
+        return self._donos[particao]
+
+    def dono(self, id_leilao: str) -> str | None:
+        return self._donos[particao_do_leilao(id_leilao)]
+
+    def url(self, id_leilao: str) -> str | None:
+        return self.instancias.get(self.dono(id_leilao))
+
+    def to_dict(self):
+        """Convert AnelConsistente instance to dictionary"""
+        return {
+            'versao': self.versao,
+            'instancias': self.instancias
+        }
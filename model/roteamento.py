@@ -0,0 +1,30 @@
+# Topic exchange for bid, winner and payment events.
+# Routing key: "<tipo>.<id_leilao>.<id_usuario>", so consumers can bind per auction or per user
+EXCHANGE_EVENTOS = "eventos_leilao"
+
+# Events addressed to everyone watching an auction
+EVENTOS_POR_LEILAO = ("lance_validado", "leilao_vencedor")
+# Events addressed to a single user
+EVENTOS_POR_USUARIO = ("lance_invalidado", "link_pagamento", "status_pagamento")
+
+def _palavra(valor) -> str:
+    """Turn an id into a single topic word (no '.', '*' or '#')"""
+    texto = "" if valor is None else str(valor)
+    return texto.replace(".", "_").replace("*", "_").replace("#", "_") or "_"
+
+def chave_evento(tipo: str, evento: dict) -> str:
+    """Routing key used to publish an event on EXCHANGE_EVENTOS"""
+    usuario = evento.get("id_usuario") or evento.get("id_vencedor")
+    return f"{tipo}.{_palavra(evento.get('id_leilao'))}.{_palavra(usuario)}"
+
+def chaves_leilao(id_leilao) -> list:
+    """Binding keys for the events of one auction"""
+    return [f"{tipo}.{_palavra(id_leilao)}.*" for tipo in EVENTOS_POR_LEILAO]
+
+def chaves_usuario(id_usuario) -> list:
+    """Binding keys for the events addressed to one user"""
+    return [f"{tipo}.*.{_palavra(id_usuario)}" for tipo in EVENTOS_POR_USUARIO]
+
+def tipo_da_chave(routing_key: str) -> str:
+    """Event type from a routing key published with chave_evento"""
+    return routing_key.split(".", 1)[0]
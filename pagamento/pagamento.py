@@ -12,6 +12,7 @@ import requests
 from pika.exchange_type import ExchangeType
 from fastapi import FastAPI, HTTPException
 from pydantic import BaseModel
+from model.roteamento import EXCHANGE_EVENTOS, chave_evento, tipo_da_chave
 
 URL_EXTERNAL_PAYMENT_SYSTEM = "http://localhost:8004"
 RABBIT_HOST = "localhost"
@@ -31,12 +32,17 @@ class NotificacaoPagamento(BaseModel):
 EVENTS = ['leilao_vencedor', 'link_pagamento', 'status_pagamento']
 
 def declare_all(channel: pika.adapters.blocking_connection.BlockingChannel):
+    # Exchanges direct antigas continuam declaradas: instâncias do MS Lance ainda
+    # não atualizadas publicam leilao_vencedor nelas durante a troca de versão
     for event_name in EVENTS:
         channel.exchange_declare(exchange=event_name, exchange_type=ExchangeType.direct, durable=True)
         channel.queue_declare(queue=event_name, durable=True)
         channel.queue_bind(exchange=event_name, queue=event_name, routing_key=event_name)
+    # Eventos novos chegam pela exchange topic ("<tipo>.<id_leilao>.<id_usuario>")
+    channel.exchange_declare(exchange=EXCHANGE_EVENTOS, exchange_type=ExchangeType.topic, durable=True)
+    channel.queue_bind(exchange=EXCHANGE_EVENTOS, queue='leilao_vencedor', routing_key='leilao_vencedor.#')
 
-def publish_event(exchange: str, routing_key: str, payload: dict):
+def publish_event(tipo: str, payload: dict):
     """
     Abre uma conexão curta para publicar (seguro entre threads).
     """
@@ -45,8 +51,8 @@ def publish_event(exchange: str, routing_key: str, payload: dict):
         ch = conn.channel()
         declare_all(ch)  # idempotente
         ch.basic_publish(
-            exchange=exchange,
-            routing_key=routing_key,
+            exchange=EXCHANGE_EVENTOS,
+            routing_key=chave_evento(tipo, payload),
             body=json.dumps(payload).encode('utf-8'),
             properties=pika.BasicProperties(delivery_mode=2, content_type="application/json")
         )
@@ -112,8 +118,8 @@ def callback_leilao_vencedor(ch, method, props, body):
             }
 
             ch.basic_publish(
-                exchange='link_pagamento',
-                routing_key='link_pagamento',
+                exchange=EXCHANGE_EVENTOS,
+                routing_key=chave_evento('link_pagamento', evento_link),
                 body=json.dumps(evento_link).encode('utf-8'),
                 properties=pika.BasicProperties(delivery_mode=2, content_type="application/json")
             )
@@ -136,7 +142,7 @@ def consume_rabbitmq_events():
     declare_all(channel)
 
     def _dispatch(ch, method, props, body):
-        if method.routing_key == 'leilao_vencedor':
+        if tipo_da_chave(method.routing_key) == 'leilao_vencedor':
             callback_leilao_vencedor(ch, method, props, body)
         else:
             ch.basic_ack(method.delivery_tag)
@@ -186,7 +192,7 @@ def receber_notificacao_pagamento(notificacao: NotificacaoPagamento):
         }
 
         # Publica usando conexão curta (seguro fora da thread do consumer)
-        publish_event('status_pagamento', 'status_pagamento', evento_status)
+        publish_event('status_pagamento', evento_status)
         print(f"[PAGAMENTO] Status de pagamento publicado: {status}")
 
         return {